@@ -1,90 +1,192 @@
 import os.path
 from pathlib import Path
 import pandas as pd
+import argparse
+import datetime
+import hashlib
+import shutil
+import subprocess
 import tarfile
 import sqlite3
+from table_schemas import read_table
 
-__version__ = "0.2.0"
+__version__ = "0.5.1"
 
 ONTOLOGY_MAPPINGS_TABLE = 'ontology_mappings'
 
+# Table that records the hash of the source file each table was imported from, used to update only changed tables
+DATABASE_SOURCES_TABLE = 'database_sources'
 
-def build_database(database_name):
+# Full-text search indexes over the labels of ontology terms and of NHANES variables
+ONTOLOGY_TERMS_FTS_TABLE = 'ontology_terms_fts'
+NHANES_VARIABLES_FTS_TABLE = 'nhanes_variables_fts'
+NHANES_VARIABLES_TEXT_COLUMNS = ["SASLabel", "EnglishText", "ProcessedText"]
+
+ONTOLOGY_TABLES_FOLDER = os.path.join("..", "ontology-tables")
+
+# The tables in the database: (table name, source TSV file). The table schemas are derived from the column data types
+# of the source files, see table_schemas.py
+DATABASE_TABLES = [
+    # The edges and database cross-references tables
+    ("ontology_edges", os.path.join(ONTOLOGY_TABLES_FOLDER, "ontology_edges.tsv")),
+    ("ontology_entailed_edges", os.path.join(ONTOLOGY_TABLES_FOLDER, "ontology_entailed_edges.tsv")),
+    ("ontology_dbxrefs", os.path.join(ONTOLOGY_TABLES_FOLDER, "ontology_dbxrefs.tsv")),
+    ("ontology_synonyms", os.path.join(ONTOLOGY_TABLES_FOLDER, "ontology_synonyms.tsv")),
+
+    # The labels table
+    ("ontology_labels", os.path.join(ONTOLOGY_TABLES_FOLDER, "ontology_labels.tsv")),
+
+    # The ontology mappings table
+    (ONTOLOGY_MAPPINGS_TABLE, os.path.join("..", "ontology-mappings", "nhanes_variables_mappings.tsv")),
+
+    # The NHANES variables metadata table
+    ("nhanes_variables_metadata", os.path.join("..", "metadata", "nhanes_variables.tsv")),
+
+    # The NHANES tables metadata table
+    ("nhanes_tables_metadata", os.path.join("..", "metadata", "nhanes_tables.tsv")),
+
+    # The table of expert-verified oral health phenotype mappings
+    ("ontology_mappings_confirmed", os.path.join("..", "ontology-mappings", "nhanes_oral_health_mappings.tsv")),
+
+    # The table of expert-contributed synonyms of variable labels
+    ("nhanes_variables_synonyms", os.path.join("resources", "synonym_table.tsv")),
+]
+
+# Compression methods for the database artifact: (file extension, external command, or None to use tarfile)
+COMPRESSION_METHODS = {
+    "xz": (".tar.xz", None),
+    "xz-mt": (".tar.xz", ["xz", "-T0", "-c"]),        # multi-threaded xz, same output format as 'xz'
+    "zstd": (".tar.zst", ["zstd", "-T0", "-10", "-c"]),  # multi-threaded zstd, much faster to (de)compress than xz
+}
+
+
+def build_database(database_name, update=False):
+    # Import all tables into the database or, if update=True, only the tables whose source files have changed since
+    # they were last imported. All changes are made in a single transaction
     Path(database_name).touch()
     db_connection = sqlite3.connect(database_name)
-    ontology_tables_folder = os.path.join("..", "ontology-tables")
-
-    # Import the edges and database cross-references tables
-    ontology_edges_table = "ontology_edges"
-    ontology_entailed_edges_table = "ontology_entailed_edges"
-    ontology_dbxrefs_table = "ontology_dbxrefs"
-    ontology_synonyms_table = "ontology_synonyms"
-    ontology_tables_columns = "Subject TEXT,Object TEXT,Ontology TEXT"
-
-    import_table_to_db(db_connection, table_file=os.path.join(ontology_tables_folder, ontology_edges_table + '.tsv'),
-                       table_name=ontology_edges_table, table_columns=ontology_tables_columns)
-
-    import_table_to_db(db_connection,
-                       table_file=os.path.join(ontology_tables_folder, ontology_entailed_edges_table + '.tsv'),
-                       table_name=ontology_entailed_edges_table, table_columns=ontology_tables_columns)
-
-    import_table_to_db(db_connection, table_file=os.path.join(ontology_tables_folder, ontology_dbxrefs_table + '.tsv'),
-                       table_name=ontology_dbxrefs_table, table_columns=ontology_tables_columns)
-
-    import_table_to_db(db_connection, table_file=os.path.join(ontology_tables_folder, ontology_synonyms_table + '.tsv'),
-                       table_name=ontology_synonyms_table, table_columns=ontology_tables_columns)
-
-    # Import the labels table
-    term_labels_table_name = "ontology_labels"
-    term_labels_table_columns = "Subject TEXT,Object TEXT,IRI TEXT,DiseaseLocation TEXT,Ontology TEXT," \
-                                "Direct INT,Inherited INT"
-    import_table_to_db(db_connection, table_file=os.path.join(ontology_tables_folder, term_labels_table_name + '.tsv'),
-                       table_name=term_labels_table_name, table_columns=term_labels_table_columns)
-
-    # Import the ontology mappings table
-    mappings_table_columns = "Variable TEXT,`Table` TEXT,SourceTermID TEXT,SourceTerm TEXT,MappedTermLabel TEXT," \
-                             "MappedTermCURIE TEXT,MappedTermIRI TEXT,MappingScore REAL,Tags TEXT,Ontology TEXT"
-    import_table_to_db(db_connection,
-                       table_file=os.path.join("..", "ontology-mappings", "nhanes_variables_mappings.tsv"),
-                       table_name=ONTOLOGY_MAPPINGS_TABLE, table_columns=mappings_table_columns)
-
-    # Import the NHANES variables metadata table
-    metadata_columns = "Variable TEXT,`Table` TEXT,SASLabel TEXT,EnglishText TEXT,EnglishInstructions TEXT,Target TEXT," \
-                       "UseConstraints TEXT,ProcessedText TEXT,Tags TEXT,IsPhenotype BOOLEAN,OntologyMapped BOOLEAN"
-    import_table_to_db(db_connection, table_file=os.path.join("..", "metadata", "nhanes_variables.tsv"),
-                       table_name="nhanes_variables_metadata", table_columns=metadata_columns)
-
-    # Import the NHANES tables metadata table
-    table_metadata_columns = "`Table` TEXT,TableName TEXT,BeginYear INT,EndYear INT,DataGroup TEXT,UseConstraints TEXT," \
-                             "DocFile TEXT,DataFile TEXT,DatePublished TEXT"
-    import_table_to_db(db_connection, table_file=os.path.join("..", "metadata", "nhanes_tables.tsv"),
-                       table_name="nhanes_tables_metadata", table_columns=table_metadata_columns)
-
-    # Import the table of expert-verified oral health phenotype mappings
-    manual_mappings_table_columns = "Variable TEXT,`Table` TEXT,SourceTermID TEXT,SourceTerm TEXT,MappedTermLabel TEXT," \
-                                    "MappedTermIRI TEXT,MappingScore REAL,Ontology TEXT,Comments TEXT"
-    import_table_to_db(db_connection,
-                       table_file=os.path.join("..", "ontology-mappings", "nhanes_oral_health_mappings.tsv"),
-                       table_name="ontology_mappings_confirmed", table_columns=manual_mappings_table_columns)
-
-    # Import the table of expert-contributed synonyms of variable labels
-    synonyms_table_columns = "Variable TEXT,`Table` TEXT,Synonym TEXT"
-    import_table_to_db(db_connection, table_file=os.path.join("resources", "synonym_table.tsv"),
-                       table_name="nhanes_variables_synonyms", table_columns=synonyms_table_columns)
-
+    db_cursor = db_connection.cursor()
+    db_cursor.execute("CREATE TABLE IF NOT EXISTS " + DATABASE_SOURCES_TABLE +
+                      " (TableName TEXT PRIMARY KEY, SourceFile TEXT, SHA256 TEXT, ImportDate TEXT)")
+    db_connection.commit()
+    recorded_hashes = dict(db_cursor.execute("SELECT TableName, SHA256 FROM " + DATABASE_SOURCES_TABLE).fetchall())
+
+    updated_tables = []
+    db_cursor.execute("BEGIN")
+    try:
+        for table_name, table_file in DATABASE_TABLES:
+            file_hash = get_file_hash(table_file)
+            if update and recorded_hashes.get(table_name) == file_hash:
+                print(f"{table_name} is up to date")
+                continue
+            print(f"Importing {table_name} from {table_file}...")
+            import_table_to_db(db_connection, table_file=table_file, table_name=table_name, commit=False)
+            db_cursor.execute("INSERT OR REPLACE INTO " + DATABASE_SOURCES_TABLE + " VALUES (?, ?, ?, ?)",
+                              (table_name, table_file, file_hash, datetime.datetime.now().isoformat()))
+            updated_tables.append(table_name)
+
+        create_indexes(db_connection)
+        if not update or {"ontology_labels", "ontology_synonyms"}.intersection(updated_tables):
+            create_ontology_terms_search_index(db_connection)
+        if not update or "nhanes_variables_metadata" in updated_tables:
+            create_nhanes_variables_search_index(db_connection)
+        db_connection.commit()
+    except BaseException:
+        db_connection.rollback()
+        raise
+    print(f"Updated {len(updated_tables)} of {len(DATABASE_TABLES)} tables")
     return db_connection
 
 
-def import_table_to_db(sql_connection, table_file, table_name, table_columns):
+def get_file_hash(file_path):
+    file_hash = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def create_indexes(sql_connection):
+    # Indexes on the columns used to look up the mappings to ontology terms and the subclasses of those terms
+    db_cursor = sql_connection.cursor()
+    db_cursor.execute("CREATE INDEX IF NOT EXISTS ontology_mappings_curie_idx ON " + ONTOLOGY_MAPPINGS_TABLE +
+                      " (MappedTermCURIE)")
+    for ontology_edges_table in ["ontology_edges", "ontology_entailed_edges"]:
+        db_cursor.execute("CREATE INDEX IF NOT EXISTS " + ontology_edges_table + "_object_idx ON " +
+                          ontology_edges_table + " (Object, Subject)")
+
+
+def create_ontology_terms_search_index(sql_connection):
+    # FTS5 index over the labels and synonyms of ontology terms, which stores its own copy of the (short) labels
     db_cursor = sql_connection.cursor()
-    db_cursor.execute('''CREATE TABLE IF NOT EXISTS ''' + table_name + ''' (''' + table_columns + ''')''')
-    data_frame = pd.read_csv(table_file, sep="\t", low_memory=False)
-    data_frame.to_sql(table_name, sql_connection, if_exists='replace', index=False)
+    db_cursor.execute("DROP TABLE IF EXISTS " + ONTOLOGY_TERMS_FTS_TABLE)
+    db_cursor.execute("CREATE VIRTUAL TABLE " + ONTOLOGY_TERMS_FTS_TABLE +
+                      " USING fts5(Subject UNINDEXED, Label, Ontology UNINDEXED, prefix='2 3')")
+    db_cursor.execute("INSERT INTO " + ONTOLOGY_TERMS_FTS_TABLE + " (Subject, Label, Ontology) "
+                      "SELECT Subject, Object, Ontology FROM ontology_labels WHERE Object IS NOT NULL "
+                      "UNION SELECT Subject, Object, Ontology FROM ontology_synonyms WHERE Object IS NOT NULL")
+
+
+def create_nhanes_variables_search_index(sql_connection):
+    # FTS5 index over the text columns of the NHANES variables metadata table, which reads the text from that table
+    db_cursor = sql_connection.cursor()
+    metadata_columns = [row[1] for row in db_cursor.execute("PRAGMA table_info(nhanes_variables_metadata)")]
+    text_columns = [column for column in NHANES_VARIABLES_TEXT_COLUMNS if column in metadata_columns]
+    db_cursor.execute("DROP TABLE IF EXISTS " + NHANES_VARIABLES_FTS_TABLE)
+    db_cursor.execute("CREATE VIRTUAL TABLE " + NHANES_VARIABLES_FTS_TABLE + " USING fts5(" +
+                      ", ".join(text_columns) + ", content='nhanes_variables_metadata', prefix='2 3')")
+    db_cursor.execute("INSERT INTO " + NHANES_VARIABLES_FTS_TABLE + " (" + NHANES_VARIABLES_FTS_TABLE + ") "
+                      "VALUES ('rebuild')")
+
+
+def import_table_to_db(sql_connection, table_file, table_name, commit=True):
+    # Replace the given table with the contents of the given TSV file. As with pandas' to_sql(if_exists='replace'), the
+    # table schema is derived from the data frame, but the rows are inserted here so that the caller controls the
+    # transaction, since to_sql commits on its own. Mapping scores are read as 64-bit floats so that they are stored
+    # exactly as written in the file
+    db_cursor = sql_connection.cursor()
+    data_frame = read_table(table_file, score_dtype="float64", low_memory=False)
+    db_cursor.execute("DROP TABLE IF EXISTS " + table_name)
+    db_cursor.execute(pd.io.sql.get_schema(data_frame, table_name))
+    placeholders = ",".join("?" * len(data_frame.columns))
+    data_frame = data_frame.astype(object).where(data_frame.notna(), None)
+    db_cursor.executemany("INSERT INTO " + table_name + " VALUES (" + placeholders + ")",
+                          data_frame.itertuples(index=False, name=None))
+    if commit:
+        sql_connection.commit()
+
+
+def compress_database(db_filepath, method="xz"):
+    # Archive the database file into a compressed tarball, using an external multi-threaded compressor if requested
+    extension, command = COMPRESSION_METHODS[method]
+    output_file = db_filepath + extension
+    print(f"Compressing {db_filepath} to {output_file}...")
+    if command is None:
+        with tarfile.open(output_file, "w:xz") as tar:
+            tar.add(db_filepath, arcname=os.path.basename(db_filepath))
+        return output_file
+    if shutil.which(command[0]) is None:
+        raise FileNotFoundError(f"Could not find the '{command[0]}' executable needed for '{method}' compression")
+    with open(output_file, "wb") as output:
+        compressor = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=output)
+        with tarfile.open(fileobj=compressor.stdin, mode="w|") as tar:
+            tar.add(db_filepath, arcname=os.path.basename(db_filepath))
+        compressor.stdin.close()
+        if compressor.wait() != 0:
+            raise RuntimeError(f"'{' '.join(command)}' failed with exit code {compressor.returncode}")
+    return output_file
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the NHANES metadata database and its compressed artifact.")
+    parser.add_argument("-u", "--update", action="store_true",
+                        help="only re-import the tables whose source files changed since the last build")
+    parser.add_argument("-c", "--compression", choices=list(COMPRESSION_METHODS) + ["none"], default="xz",
+                        help="compression method for the database artifact (default: xz)")
+    arguments = parser.parse_args()
+
     db_name = "nhanes_metadata.db"
     db_filepath = os.path.join('..', db_name)
-    build_database(db_filepath)
-    with tarfile.open(db_filepath + ".tar.xz", "w:xz") as tar:
-        tar.add(db_filepath, arcname=db_name)
+    build_database(db_filepath, update=arguments.update).close()
+    if arguments.compression != "none":
+        compress_database(db_filepath, method=arguments.compression)
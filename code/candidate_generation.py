@@ -0,0 +1,239 @@
+import hashlib
+import io
+import os
+import pickle
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import TfidfVectorizer
+from text2term import onto_utils
+from text2term.onto_cache import CACHE_FOLDER
+from text2term.term import OntologyTermType
+from text2term.term_collector import filter_terms
+from table_schemas import get_dtypes
+
+__version__ = "0.4.0"
+
+# Input data: the labels and synonyms tables extracted by generate_ontology_tables.py
+ONTOLOGY_LABELS_TABLE = os.path.join("..", "ontology-tables", "ontology_labels.tsv")
+ONTOLOGY_SYNONYMS_TABLE = os.path.join("..", "ontology-tables", "ontology_synonyms.tsv")
+
+SUBJECT_COL = "Subject"
+OBJECT_COL = "Object"
+IRI_COL = "IRI"
+ONTOLOGY_COL = "Ontology"
+TERM_LABEL_COL = "TermLabel"
+IS_SYNONYM_COL = "IsSynonym"
+
+# Candidate generation configuration. Ontology labels and synonyms are vectorized the same way the text2term TF-IDF
+# mapper does it (normalized text, TF-IDF weighted character 3-grams within word boundaries)
+NGRAM_SIZE = 3
+MAX_CANDIDATES = 50
+BATCH_SIZE = 1000
+
+
+class CandidateIndex:
+    # Sparse TF-IDF matrix of the labels and synonyms of the terms in one ontology, used to shortlist the ontology terms
+    # that are most similar to each source term with a batched sparse matrix product, and then to score each source
+    # term against the labels of its shortlisted terms only
+
+    def __init__(self, curies, labels, normalize_labels=True, term_labels=None):
+        self.label_curies = np.asarray(curies, dtype=object)
+        self.term_labels = term_labels  # the label reported for each term, for indexes built from ontology terms
+        self.vectorizer = TfidfVectorizer(analyzer="char_wb", ngram_range=(NGRAM_SIZE, NGRAM_SIZE))
+        if normalize_labels:
+            labels = onto_utils.normalize_list(labels)
+        # labels x n-grams matrix, and its transpose so that products with source term vectors give labels as columns
+        self.label_matrix = self.vectorizer.fit_transform(labels).tocsr()
+        self.label_matrix_t = self.label_matrix.T.tocsr()
+        self.term_label_rows = pd.Series(np.arange(len(self.label_curies))).groupby(self.label_curies).indices
+
+    @classmethod
+    def from_ontology_terms(cls, ontology_terms):
+        # Build the index, keyed by IRI, from the ontology terms loaded from a text2term cache (see
+        # load_cached_ontology_terms). The labels and synonyms are vectorized without normalization, exactly as
+        # text2term's TF-IDF mapper vectorizes its target labels, so that score_shortlists gives text2term's scores
+        iris, labels, term_labels = [], [], {}
+        for term in ontology_terms.values():
+            term_labels[term.iri] = term.label
+            for label in list(term.labels) + list(term.synonyms):
+                iris.append(term.iri)
+                labels.append(label)
+        return cls(iris, labels, normalize_labels=False, term_labels=term_labels)
+
+    def top_candidates(self, terms, max_candidates=MAX_CANDIDATES, batch_size=BATCH_SIZE):
+        # Get, for each given term, a list of up to max_candidates (CURIE, score) tuples sorted by decreasing cosine
+        # similarity between the term and the best matching label or synonym of each candidate ontology term
+        candidates = []
+        terms = onto_utils.normalize_list([str(term) for term in terms])
+        for batch_start in range(0, len(terms), batch_size):
+            batch = terms[batch_start:batch_start + batch_size]
+            scores = (self.vectorizer.transform(batch) @ self.label_matrix_t).tocsr()
+            for row in range(scores.shape[0]):
+                row_scores = scores.data[scores.indptr[row]:scores.indptr[row + 1]]
+                row_labels = scores.indices[scores.indptr[row]:scores.indptr[row + 1]]
+                candidates.append(self._rank_candidates(row_labels, row_scores, max_candidates))
+        return candidates
+
+    def _rank_candidates(self, label_ids, scores, max_candidates):
+        # several labels may belong to the same term, so keep a few more labels than the number of candidates needed
+        max_labels = max_candidates * 10
+        if scores.size > max_labels:
+            top_labels = np.argpartition(-scores, max_labels)[:max_labels]
+            label_ids, scores = label_ids[top_labels], scores[top_labels]
+        order = np.argsort(-scores, kind="stable")
+        term_candidates = []
+        seen = set()
+        for label_id, score in zip(label_ids[order], scores[order]):
+            curie = self.label_curies[label_id]
+            if curie not in seen:  # keep only the best scoring label of each ontology term
+                seen.add(curie)
+                term_candidates.append((curie, float(score)))
+                if len(term_candidates) == max_candidates:
+                    break
+        return term_candidates
+
+    def score_shortlists(self, terms, shortlists, batch_size=BATCH_SIZE, fit_terms=None):
+        # Score each of the given terms against the labels of the candidate terms in its shortlist (as returned by
+        # top_candidates), the way text2term's TF-IDF mapper scores a term against every label in the ontology: the
+        # terms are TF-IDF weighted among fit_terms (by default, among themselves), the labels among all the labels in
+        # the index, and the score is the cosine similarity of the two vectors. Pass all the terms given to text2term
+        # as fit_terms to get text2term's scores. Returns, for each term, a list of (term id, score) tuples with the
+        # score of the best scoring label of each candidate term, sorted by decreasing score
+        terms = onto_utils.normalize_list([str(term) for term in terms])
+        if not any(shortlists):
+            return [[] for _ in terms]
+        term_vectorizer = TfidfVectorizer(analyzer="char_wb", ngram_range=(NGRAM_SIZE, NGRAM_SIZE))
+        if fit_terms is not None:
+            term_vectorizer.fit(onto_utils.normalize_list([str(term) for term in fit_terms]))
+            term_matrix = term_vectorizer.transform(terms)
+        else:
+            term_matrix = term_vectorizer.fit_transform(terms)
+        term_matrix = self._to_label_ngrams(term_matrix, term_vectorizer)
+        scored_shortlists = []
+        for batch_start in range(0, len(terms), batch_size):
+            batch_shortlists = shortlists[batch_start:batch_start + batch_size]
+            pair_terms, pair_labels, pair_candidates = [], [], []
+            for row, shortlist in enumerate(batch_shortlists, start=batch_start):
+                for candidate, _ in shortlist:
+                    label_rows = self.term_label_rows[candidate]
+                    pair_terms.extend([row] * len(label_rows))
+                    pair_labels.extend(label_rows)
+                    pair_candidates.extend([candidate] * len(label_rows))
+            # row-wise dot products of the (unit length) term and label vectors of every (term, label) pair
+            scores = np.asarray(term_matrix[pair_terms].multiply(self.label_matrix[pair_labels]).sum(axis=1)).ravel()
+            pairs = pd.DataFrame({"Term": pair_terms, "Candidate": pair_candidates, "Score": scores})
+            best_scores = pairs.groupby(["Term", "Candidate"], sort=False)["Score"].max().reset_index()
+            best_scores = best_scores.sort_values(["Term", "Score"], ascending=[True, False], kind="mergesort")
+            term_scores = {term: list(zip(group["Candidate"], group["Score"].astype(float)))
+                           for term, group in best_scores.groupby("Term", sort=False)}
+            scored_shortlists.extend(term_scores.get(row, []) for row in range(batch_start,
+                                                                               batch_start + len(batch_shortlists)))
+        return scored_shortlists
+
+    def _to_label_ngrams(self, term_matrix, term_vectorizer):
+        # Re-index the columns of a matrix of term vectors from the term vectorizer's n-grams to the label vectorizer's
+        # n-grams. N-grams that no label has are dropped, but the vectors keep their length (as in text2term, where the
+        # vocabulary of both is the union of their n-grams), so the dot products with label vectors are cosines
+        columns = np.full(term_matrix.shape[1], -1)
+        for ngram, column in term_vectorizer.vocabulary_.items():
+            columns[column] = self.vectorizer.vocabulary_.get(ngram, -1)
+        term_matrix = term_matrix.tocoo()
+        keep = columns[term_matrix.col] >= 0
+        return sp.csr_matrix((term_matrix.data[keep], (term_matrix.row[keep], columns[term_matrix.col[keep]])),
+                             shape=(term_matrix.shape[0], len(self.vectorizer.vocabulary_)))
+
+
+class ExactMatchIndex:
+    # Hash index from the normalized labels and exact synonyms of the terms in one ontology to those terms. When several
+    # terms share a normalized label, terms whose rdfs:label (rather than a synonym) matches are preferred, and then
+    # terms with the lowest CURIE, so that lookups are deterministic
+
+    def __init__(self, ontology_labels):
+        ontology_labels = ontology_labels.assign(NormalizedLabel=onto_utils.normalize_list(ontology_labels[OBJECT_COL]))
+        ontology_labels = ontology_labels[ontology_labels["NormalizedLabel"] != ""]
+        ontology_labels = ontology_labels.sort_values([IS_SYNONYM_COL, SUBJECT_COL], kind="mergesort")
+        ontology_labels = ontology_labels.drop_duplicates(subset=["NormalizedLabel"], keep="first")
+        # derive the CURIEs from the IRIs as text2term does, so that exact and text2term mappings to the same term have
+        # the same CURIE (the ontology tables rewrite some prefixes, e.g. ORPHANET.ORDO to ORDO)
+        curies = {iri: onto_utils.curie_from_iri(iri) for iri in ontology_labels[IRI_COL].dropna().unique()}
+        mapped_term_curies = [curies.get(iri) or subject for iri, subject in
+                              zip(ontology_labels[IRI_COL], ontology_labels[SUBJECT_COL])]
+        self.index = dict(zip(ontology_labels["NormalizedLabel"],
+                              zip(mapped_term_curies, ontology_labels[TERM_LABEL_COL], ontology_labels[IRI_COL])))
+
+    def __len__(self):
+        return len(self.index)
+
+    def lookup(self, term):
+        # Get the (CURIE, label, IRI) of the ontology term whose label or exact synonym matches the given term after
+        # normalization, or None if there is no such term
+        if not isinstance(term, str):
+            return None
+        return self.index.get(onto_utils.normalize(term))
+
+
+def get_ontology_labels(ontology, base_iris=(), labels_file=ONTOLOGY_LABELS_TABLE,
+                        synonyms_file=ONTOLOGY_SYNONYMS_TABLE):
+    # Get a data frame with the labels and exact synonyms of the non-deprecated terms in the given ontology, limited to
+    # terms whose IRIs start with one of the given base IRIs (like text2term does), or None if the ontology tables are
+    # not available or contain no terms from the given ontology
+    ontology_tables = load_ontology_tables(labels_file, synonyms_file)
+    if ontology_tables is None:
+        return None
+    all_labels_df, all_synonyms_df, _ = ontology_tables
+    labels_df = all_labels_df[all_labels_df[ONTOLOGY_COL] == ontology]
+    if isinstance(base_iris, str):
+        base_iris = (base_iris,)
+    if len(base_iris) > 0:
+        labels_df = labels_df[labels_df[IRI_COL].fillna("").str.startswith(tuple(base_iris))]
+    if labels_df.empty:
+        return None
+    labels_df = labels_df.assign(**{TERM_LABEL_COL: labels_df[OBJECT_COL], IS_SYNONYM_COL: False})
+    synonyms_df = all_synonyms_df[all_synonyms_df[ONTOLOGY_COL] == ontology]
+    synonyms_df = synonyms_df.merge(labels_df[[SUBJECT_COL, TERM_LABEL_COL, IRI_COL]], on=SUBJECT_COL)
+    synonyms_df[IS_SYNONYM_COL] = True
+    columns = [SUBJECT_COL, OBJECT_COL, TERM_LABEL_COL, IRI_COL, IS_SYNONYM_COL]
+    ontology_labels = pd.concat([labels_df[columns], synonyms_df[columns]], ignore_index=True)
+    ontology_labels[OBJECT_COL] = ontology_labels[OBJECT_COL].astype(str)
+    return ontology_labels.drop_duplicates(subset=[SUBJECT_COL, OBJECT_COL])
+
+
+def load_ontology_tables(labels_file=ONTOLOGY_LABELS_TABLE, synonyms_file=ONTOLOGY_SYNONYMS_TABLE):
+    # Get the labels and synonyms tables of all ontologies, and a digest of their contents, or None if the tables are
+    # not available. The tables are read once and kept in memory until either file is modified
+    if not (os.path.exists(labels_file) and os.path.exists(synonyms_file)):
+        return None
+    return _load_ontology_tables(labels_file, synonyms_file,
+                                 (os.stat(labels_file).st_mtime_ns, os.stat(synonyms_file).st_mtime_ns))
+
+
+@lru_cache(maxsize=1)
+def _load_ontology_tables(labels_file, synonyms_file, modification_times):
+    digest = hashlib.sha1()
+    tables = []
+    for table_file, columns in [(labels_file, [SUBJECT_COL, OBJECT_COL, IRI_COL, ONTOLOGY_COL]),
+                                (synonyms_file, [SUBJECT_COL, OBJECT_COL, ONTOLOGY_COL])]:
+        with open(table_file, "rb") as table:
+            contents = table.read()
+        digest.update(contents)
+        table_df = pd.read_csv(io.BytesIO(contents), sep="\t", usecols=columns, dtype=get_dtypes(table_file),
+                               low_memory=False)
+        tables.append(table_df.dropna(subset=[SUBJECT_COL, OBJECT_COL]))
+    return tables[0], tables[1], digest.hexdigest()[:12]
+
+
+def get_cache_file(ontology):
+    # Get the file with the terms of the given ontology in its text2term cache
+    return os.path.join(CACHE_FOLDER, ontology, ontology + "-term-details.pickle")
+
+
+def load_cached_ontology_terms(ontology, base_iris=()):
+    # Load the non-deprecated classes of the given ontology from its text2term cache, limited to terms whose IRIs start
+    # with one of the given base IRIs, as text2term.map_terms(use_cache=True, excl_deprecated=True) does on each call
+    with open(get_cache_file(ontology), "rb") as cached_ontology:
+        ontology_terms = pickle.load(cached_ontology)
+    if isinstance(base_iris, str):
+        base_iris = (base_iris,)
+    return filter_terms(ontology_terms, tuple(base_iris), excl_deprecated=True, term_type=OntologyTermType.CLASS)
@@ -1,14 +1,15 @@
 import os
 import pandas as pd
 from generate_mapping_report import get_mapping_counts_to_ontologies
+from table_schemas import read_table
 
-__version__ = "0.2.0"
+__version__ = "0.3.0"
 
 ONTOLOGY_TABLES_FOLDER = "../ontology-tables/"
 
 if __name__ == "__main__":
     mapping_counts_df = get_mapping_counts_to_ontologies(
-        mappings_df=pd.read_csv("../ontology-mappings/nhanes_variables_mappings.tsv", sep="\t"),
+        mappings_df=read_table("../ontology-mappings/nhanes_variables_mappings.tsv"),
         ontologies_df=pd.read_csv("resources/ontologies.csv"),
         save_ontology=True)
 
@@ -21,7 +22,7 @@ if __name__ == "__main__":
 
     for labels_file in labels_files:
         labels_file_path = os.path.join(ONTOLOGY_TABLES_FOLDER, labels_file)
-        labels_df = pd.read_csv(labels_file_path, sep="\t", low_memory=False)
+        labels_df = read_table(labels_file_path, low_memory=False)
 
         # Merge the counts table with the labels table on the "IRI" column
         merged_df = pd.merge(labels_df, mapping_counts_df, on="IRI")
@@ -1,10 +1,16 @@
 from pathlib import Path
+import hashlib
+import os
+import shutil
 import pandas as pd
 import text2term
+from text2term import onto_utils
 import preprocess_metadata
+import candidate_generation
+import table_schemas
 import csv
 
-__version__ = "0.9.4"
+__version__ = "0.12.0"
 
 # How the stack looks:
 #                                  map_to_ontology
@@ -34,17 +40,39 @@ NHANES_ORAL_HEALTH_MAPPINGS = "../ontology-mappings/nhanes_oral_health_mappings.
 # Mapping configuration
 MAX_MAPPINGS_PER_ONTOLOGY = 1
 MIN_MAPPING_SCORE = 0.7
+# The (TF-IDF) candidate generation stage shortlists the MAX_CANDIDATES ontology terms most similar to each source term,
+# and the source term is then scored with text2term's TF-IDF scoring against the labels of its shortlisted terms only,
+# rather than against the whole ontology. Source terms whose best candidate scores below MIN_CANDIDATE_SCORE are not
+# scored at all, and are reported as unmapped. The threshold is lower than MIN_MAPPING_SCORE because the candidate
+# scores are computed with ontology-wide rather than per-run TF-IDF weights
+USE_CANDIDATE_SHORTLISTS = True
+MAX_CANDIDATES = 50
+USE_CANDIDATE_PREFILTER = True
+MIN_CANDIDATE_SCORE = 0.5
+# Source terms that match the label or an exact synonym of an ontology term verbatim (after normalization) are mapped
+# to that term with a score of 1, without going through the text2term matcher
+USE_EXACT_MATCHES = True
+EXACT_MATCH_SCORE = 1.0
 MAPPINGS_OUTPUT_FOLDER = "../ontology-mappings/"
+# Variables are mapped in chunks of this many source terms per ontology, and the mappings of each chunk are saved to
+# the checkpoints folder so that an interrupted run can be resumed without redoing the chunks already mapped
+MAPPING_CHUNK_SIZE = 5000
+MAPPING_CHECKPOINTS_FOLDER = "checkpoints/"
 TARGET_ONTOLOGIES = "resources/ontologies.csv"
 
 # Mappings data frame columns configuration
 NHANES_TABLE_ID_COL = "Table"
 NHANES_TABLE_NAME_COL = "TableName"
 SOURCE_TERM_COL = "Source Term"
+SOURCE_TERM_ID_COL = "Source Term ID"
 NHANES_VARIABLE_ID_COL = "Variable"
 NHANES_VARIABLE_COMBINED_ID_COL = "VariableID"
 MAPPING_SCORE_COL = "Mapping Score"
+MAPPED_TERM_CURIE_COL = "Mapped Term CURIE"
 ONTOLOGY_COL = "Ontology"
+# Columns of the mappings data frames output by text2term
+MAPPINGS_COLUMNS = [SOURCE_TERM_ID_COL, SOURCE_TERM_COL, "Mapped Term Label", MAPPED_TERM_CURIE_COL, "Mapped Term IRI",
+                    MAPPING_SCORE_COL, "Tags"]
 
 NHANES_VARIABLE_LABEL_COL = "SASLabel"
 NHANES_VARIABLE_LABEL_PROCESSED_COL = "ProcessedText"
@@ -55,51 +83,227 @@ UNMAPPED = "unmapped"
 
 # Map the given terms to the target ontology
 def map_to_ontology(target_ontology, terms_to_map, term_identifiers, base_iris=(), min_mapping_score=MIN_MAPPING_SCORE,
-                    max_mappings=MAX_MAPPINGS_PER_ONTOLOGY):
+                    max_mappings=MAX_MAPPINGS_PER_ONTOLOGY, candidate_index=None, exact_match_index=None):
     if not text2term.cache_exists(target_ontology):
         raise FileNotFoundError("Could not find cache file for ontology: " + target_ontology)
-    mappings_df = text2term.map_terms(
-        source_terms=terms_to_map,
-        target_ontology=target_ontology,
-        source_terms_ids=term_identifiers,
-        max_mappings=max_mappings,
-        min_score=min_mapping_score,
-        base_iris=base_iris,
-        excl_deprecated=True,
-        save_mappings=False,
-        use_cache=True,
-        incl_unmapped=True
-    )
+    exact_mappings_df = unmapped_df = pd.DataFrame()
+    # text2term weights the terms among all the terms it is given, except those tagged to be ignored
+    all_labels = [label for label, tags in map(_get_label_and_tags, terms_to_map) if IGNORE_TAG not in tags.split(",")]
+    if exact_match_index is not None:
+        terms_to_map, term_identifiers, exact_mappings_df = map_exact_matches(exact_match_index, terms_to_map,
+                                                                             term_identifiers)
+    shortlists = None
+    if candidate_index is not None and len(terms_to_map) > 0:
+        min_candidate_score = MIN_CANDIDATE_SCORE if USE_CANDIDATE_PREFILTER else 0.0
+        terms_to_map, term_identifiers, shortlists, unmapped_df = prefilter_terms(
+            candidate_index, terms_to_map, term_identifiers, min_candidate_score=min_candidate_score)
+    mappings_df = pd.DataFrame()
+    if len(terms_to_map) > 0 and shortlists is not None and USE_CANDIDATE_SHORTLISTS:
+        mappings_df = map_to_shortlists(candidate_index, terms_to_map, term_identifiers, shortlists,
+                                        min_mapping_score=min_mapping_score, max_mappings=max_mappings,
+                                        fit_terms=all_labels)
+    elif len(terms_to_map) > 0:
+        mappings_df = text2term.map_terms(
+            source_terms=terms_to_map,
+            target_ontology=target_ontology,
+            source_terms_ids=term_identifiers,
+            max_mappings=max_mappings,
+            min_score=min_mapping_score,
+            base_iris=base_iris,
+            excl_deprecated=True,
+            save_mappings=False,
+            use_cache=True,
+            incl_unmapped=True
+        )
+    mappings_df = pd.concat([mappings_df, exact_mappings_df, unmapped_df], ignore_index=True)
     mappings_df[ONTOLOGY_COL] = target_ontology
     return mappings_df
 
 
-# Map the given terms to all ontologies listed in the ontologies table
-def map_to_ontologies(ontologies_table, terms_to_map, term_identifiers):
+# Split the given terms into those that match the label or an exact synonym of an ontology term, which are returned as
+# mappings with the maximum score, and those that do not, which are returned to be mapped by text2term
+def map_exact_matches(exact_match_index, terms_to_map, term_identifiers):
+    remaining_terms, remaining_ids, exact_mappings = [], [], []
+    for term, term_id in zip(terms_to_map, term_identifiers):
+        label, tags = _get_label_and_tags(term)
+        match = exact_match_index.lookup(label) if IGNORE_TAG not in tags.split(",") else None
+        if match is not None:
+            mapped_term_curie, mapped_term_label, mapped_term_iri = match
+            exact_mappings.append((term_id, label, mapped_term_label, mapped_term_curie, mapped_term_iri,
+                                   EXACT_MATCH_SCORE, tags))
+        else:
+            remaining_terms.append(term)
+            remaining_ids.append(term_id)
+    print(f"...{len(exact_mappings)} of {len(terms_to_map)} terms have exact matches")
+    return remaining_terms, remaining_ids, pd.DataFrame(exact_mappings, columns=MAPPINGS_COLUMNS)
+
+
+# Split the given terms into those that have at least one candidate ontology term that scores above the minimum
+# candidate score, which are returned for mapping along with their shortlists of candidates, and those that do not,
+# which are returned as unmapped
+def prefilter_terms(candidate_index, terms_to_map, term_identifiers, min_candidate_score=MIN_CANDIDATE_SCORE,
+                    max_candidates=MAX_CANDIDATES):
+    labels_and_tags = [_get_label_and_tags(term) for term in terms_to_map]
+    candidates = candidate_index.top_candidates([label for label, tags in labels_and_tags],
+                                                max_candidates=max_candidates)
+    keep_terms, keep_ids, shortlists, unmapped = [], [], [], []
+    for term, (label, tags), term_id, term_candidates in zip(terms_to_map, labels_and_tags, term_identifiers,
+                                                             candidates):
+        if term_candidates and term_candidates[0][1] >= min_candidate_score:
+            keep_terms.append(term)
+            keep_ids.append(term_id)
+            shortlists.append(term_candidates)
+        else:
+            unmapped.append(_unmapped_mapping(term, term_id, label, tags))
+    print(f"...{len(keep_terms)} of {len(terms_to_map)} terms have candidate mappings")
+    return keep_terms, keep_ids, shortlists, pd.DataFrame(unmapped, columns=MAPPINGS_COLUMNS)
+
+
+# Map the given terms to the ontology terms in their shortlists of candidates, scored as text2term's TF-IDF mapper
+# scores them when it is given the fit_terms (by default, the given terms), and return the mappings in the format of
+# text2term.map_terms(incl_unmapped=True): the max_mappings best scoring terms with a score of at least
+# min_mapping_score, or an unmapped row. Terms tagged to be ignored are not scored and are reported as unmapped, as
+# text2term does
+def map_to_shortlists(candidate_index, terms_to_map, term_identifiers, shortlists, min_mapping_score=MIN_MAPPING_SCORE,
+                      max_mappings=MAX_MAPPINGS_PER_ONTOLOGY, fit_terms=None):
+    labels_and_tags = [_get_label_and_tags(term) for term in terms_to_map]
+    to_score = [index for index, (label, tags) in enumerate(labels_and_tags) if IGNORE_TAG not in tags.split(",")]
+    scores = candidate_index.score_shortlists([labels_and_tags[index][0] for index in to_score],
+                                              [shortlists[index] for index in to_score], fit_terms=fit_terms)
+    term_scores = dict(zip(to_score, scores))
+    mappings, curies = [], {}
+    for index, (term, term_id, (label, tags)) in enumerate(zip(terms_to_map, term_identifiers, labels_and_tags)):
+        term_mappings = [(iri, score) for iri, score in term_scores.get(index, []) if score >= min_mapping_score]
+        for mapped_term_iri, score in term_mappings[:max_mappings]:
+            if mapped_term_iri not in curies:
+                curies[mapped_term_iri] = onto_utils.curie_from_iri(mapped_term_iri)
+            mappings.append((term_id, label, candidate_index.term_labels[mapped_term_iri], curies[mapped_term_iri],
+                             mapped_term_iri, score, tags))
+        if not term_mappings:
+            mappings.append(_unmapped_mapping(term, term_id, label, tags))
+    mappings_df = pd.DataFrame(mappings, columns=MAPPINGS_COLUMNS)
+    mappings_df[MAPPING_SCORE_COL] = mappings_df[MAPPING_SCORE_COL].astype(float).round(decimals=3)
+    return mappings_df
+
+
+def _unmapped_mapping(term, term_id, label, tags):
+    if not isinstance(term, text2term.TaggedTerm):  # text2term only tags untagged terms as unmapped
+        tags = UNMAPPED
+    return term_id, label, "", "", "", 0.0, tags
+
+
+def _get_label_and_tags(term):
+    # Get the label of the given (possibly tagged) term, and its tags as text2term writes them in the mappings data frame
+    if isinstance(term, text2term.TaggedTerm):
+        return term.get_term(), ",".join(term.get_tags())
+    return term, "None"
+
+
+def _get_match_indexes(ontology_name, base_iris=()):
+    # Build the exact match index of the given ontology from the extracted ontology tables, if available, and its
+    # candidate index from the terms in its text2term cache, if available
+    exact_match_index = candidate_index = None
+    if USE_EXACT_MATCHES:
+        ontology_labels = candidate_generation.get_ontology_labels(ontology_name, base_iris=base_iris)
+        if ontology_labels is not None:
+            exact_match_index = candidate_generation.ExactMatchIndex(ontology_labels)
+    if (USE_CANDIDATE_SHORTLISTS or USE_CANDIDATE_PREFILTER) and text2term.cache_exists(ontology_name):
+        ontology_terms = candidate_generation.load_cached_ontology_terms(ontology_name, base_iris=base_iris)
+        candidate_index = candidate_generation.CandidateIndex.from_ontology_terms(ontology_terms)
+    return exact_match_index, candidate_index
+
+
+# Map the given terms to all ontologies listed in the ontologies table, optionally in chunks of chunk_size terms whose
+# mappings are saved to (and, when rerun, loaded from) the given checkpoint folder
+def map_to_ontologies(ontologies_table, terms_to_map, term_identifiers, chunk_size=None, checkpoint_folder=None):
     ontologies_table = pd.read_csv(ontologies_table)
     all_mappings = pd.DataFrame()
+    ontology_tables = candidate_generation.load_ontology_tables() if USE_EXACT_MATCHES else None
+    ontology_tables_digest = ontology_tables[2] if ontology_tables is not None else ""
     for index, row in ontologies_table.iterrows():
         ontology_name = row['acronym']
         limit_to_base_iris = row['iris']
         if not pd.isna(limit_to_base_iris):
             if "," in limit_to_base_iris:
                 limit_to_base_iris = tuple(limit_to_base_iris.split(","))
+        else:
+            limit_to_base_iris = ()
+        exact_match_index, candidate_index = _get_match_indexes(ontology_name, base_iris=limit_to_base_iris)
+        if chunk_size is None:
             ontology_mappings = map_to_ontology(target_ontology=ontology_name, base_iris=limit_to_base_iris,
-                                                terms_to_map=terms_to_map, term_identifiers=term_identifiers)
+                                                terms_to_map=terms_to_map, term_identifiers=term_identifiers,
+                                                candidate_index=candidate_index, exact_match_index=exact_match_index)
         else:
-            ontology_mappings = map_to_ontology(target_ontology=ontology_name,
-                                                terms_to_map=terms_to_map, term_identifiers=term_identifiers)
+            # the checkpoints of an ontology are only reused while its version, its text2term cache and the ontology
+            # tables used for exact matching are the same as when the checkpoints were written
+            cache_digest = _files_digest(candidate_generation.get_cache_file(ontology_name))
+            inputs_digest = f"{row['version']}|{ontology_tables_digest}|{cache_digest}"
+            ontology_mappings = _map_to_ontology_in_chunks(ontology_name, limit_to_base_iris, terms_to_map,
+                                                           term_identifiers, chunk_size, checkpoint_folder,
+                                                           candidate_index, exact_match_index, inputs_digest)
         all_mappings = pd.concat([all_mappings, ontology_mappings])
     all_mappings = all_mappings.drop_duplicates()
-    return all_mappings
-
-
-def map_data(source_df, labels_column, label_ids_column, tags_column=""):
+    return table_schemas.apply_dtypes(all_mappings, table_schemas.MAPPINGS_DTYPES)
+
+
+def _map_to_ontology_in_chunks(ontology_name, base_iris, terms_to_map, term_identifiers, chunk_size, checkpoint_folder,
+                               candidate_index, exact_match_index, inputs_digest=""):
+    chunks = [(terms_to_map[start:start + chunk_size], term_identifiers[start:start + chunk_size])
+              for start in range(0, len(terms_to_map), chunk_size)]
+    # name each checkpoint after a digest of its terms, of the mapping settings and of the given ontology inputs digest,
+    # so that checkpoints are not reused when any of these change
+    checkpoint_files = [os.path.join(checkpoint_folder, f"{ontology_name}_{number:05d}_"
+                                     f"{_chunk_digest(ontology_name, base_iris, terms, ids, inputs_digest)}.tsv")
+                        for number, (terms, ids) in enumerate(chunks)]
+    Path(checkpoint_folder).mkdir(exist_ok=True, parents=True)
+    chunk_mappings = []
+    for number, ((terms, ids), checkpoint_file) in enumerate(zip(chunks, checkpoint_files)):
+        if os.path.exists(checkpoint_file):
+            print(f"Loading {ontology_name} mappings of chunk {number + 1}/{len(chunks)} from {checkpoint_file}")
+            mappings_df = pd.read_csv(checkpoint_file, sep="\t", keep_default_na=False, dtype={SOURCE_TERM_ID_COL: str})
+        else:
+            print(f"Mapping chunk {number + 1}/{len(chunks)} to {ontology_name}...")
+            mappings_df = map_to_ontology(target_ontology=ontology_name, base_iris=base_iris, terms_to_map=terms,
+                                          term_identifiers=ids, candidate_index=candidate_index,
+                                          exact_match_index=exact_match_index)
+            # write to a temporary file first so that an interrupted write does not leave a partial checkpoint behind
+            mappings_df.to_csv(checkpoint_file + ".tmp", sep="\t", index=False)
+            os.replace(checkpoint_file + ".tmp", checkpoint_file)
+        chunk_mappings.append(mappings_df)
+    return pd.concat(chunk_mappings, ignore_index=True)
+
+
+def _chunk_digest(ontology_name, base_iris, terms, term_identifiers, inputs_digest=""):
+    digest = hashlib.sha1()
+    digest.update(f"{ontology_name}|{base_iris}|{inputs_digest}|{MIN_MAPPING_SCORE}|{MAX_MAPPINGS_PER_ONTOLOGY}|"
+                  f"{USE_EXACT_MATCHES}|{USE_CANDIDATE_PREFILTER}|{MIN_CANDIDATE_SCORE}|{USE_CANDIDATE_SHORTLISTS}|"
+                  f"{MAX_CANDIDATES}".encode())
+    for term, term_id in zip(terms, term_identifiers):
+        label, tags = _get_label_and_tags(term)
+        digest.update(f"\n{term_id}\t{label}\t{tags}".encode())
+    return digest.hexdigest()[:12]
+
+
+def _files_digest(*files):
+    # Get a digest of the contents of the given files, where a missing file contributes only its name
+    digest = hashlib.sha1()
+    for file in files:
+        digest.update(file.encode())
+        if os.path.exists(file):
+            with open(file, "rb") as file_contents:
+                for block in iter(lambda: file_contents.read(1 << 20), b""):
+                    digest.update(block)
+    return digest.hexdigest()[:12]
+
+
+def map_data(source_df, labels_column, label_ids_column, tags_column="", chunk_size=None, checkpoint_folder=None):
     terms, term_ids = get_terms_and_ids(source_df, labels_column, label_ids_column, tags_column)
     mappings_df = map_to_ontologies(
         terms_to_map=terms,
         term_identifiers=term_ids,
-        ontologies_table=TARGET_ONTOLOGIES)
+        ontologies_table=TARGET_ONTOLOGIES,
+        chunk_size=chunk_size,
+        checkpoint_folder=checkpoint_folder)
     return mappings_df
 
 def get_terms_and_ids(nhanes_table, label_col, label_id_col, tags_column=""):
@@ -115,10 +319,12 @@ def get_terms_and_ids(nhanes_table, label_col, label_id_col, tags_column=""):
     return terms, term_ids
 
 
-def map_data_with_composite_ids(df, labels_column, variable_id_column, table_id_column, tags_column=""):
+def map_data_with_composite_ids(df, labels_column, variable_id_column, table_id_column, tags_column="",
+                                chunk_size=None, checkpoint_folder=None):
     sep = "-"
-    df[NHANES_VARIABLE_COMBINED_ID_COL] = df[variable_id_column].astype(str) + sep + df[table_id_column]
-    mappings_df = map_data(df, labels_column, NHANES_VARIABLE_COMBINED_ID_COL, tags_column=tags_column)
+    df[NHANES_VARIABLE_COMBINED_ID_COL] = df[variable_id_column].astype(str) + sep + df[table_id_column].astype(str)
+    mappings_df = map_data(df, labels_column, NHANES_VARIABLE_COMBINED_ID_COL, tags_column=tags_column,
+                           chunk_size=chunk_size, checkpoint_folder=checkpoint_folder)
     expanded_df = expand_composite_ids(mappings_df, variable_id_column, table_id_column, "Source Term ID", sep=sep)
     return expanded_df
 
@@ -130,13 +336,37 @@ def expand_composite_ids(df, id_1_col, id_2_col, mappings_df_id_col, sep="-"):
     return df
 
 
-def top_mappings(mappings_df):
-    # group the mappings data frame by the composite identifier and get the row with the maximum score for each group
-    max_scores = mappings_df.groupby([NHANES_VARIABLE_ID_COL, NHANES_TABLE_ID_COL])[MAPPING_SCORE_COL].max().reset_index()
+def sort_mappings(mappings_df, id_columns=(NHANES_VARIABLE_ID_COL, NHANES_TABLE_ID_COL)):
+    # sort the mappings of each source term by decreasing score, breaking ties by ontology and mapped term so that
+    # the order (and therefore any top-k selection) is the same across runs
+    sort_columns = list(id_columns) + [MAPPING_SCORE_COL] + \
+                   [col for col in [ONTOLOGY_COL, MAPPED_TERM_CURIE_COL] if col in mappings_df.columns]
+    ascending = [col != MAPPING_SCORE_COL for col in sort_columns]
+    return mappings_df.sort_values(sort_columns, ascending=ascending, kind="mergesort", ignore_index=True)
+
+
+def top_mappings(mappings_df, k=1, k_per_ontology=None, id_columns=(NHANES_VARIABLE_ID_COL, NHANES_TABLE_ID_COL),
+                 presorted=False, keep_ties=True):
+    # keep the k highest scoring mappings of each source term, and at most k_per_ontology of those from any single
+    # ontology. With keep_ties=True, mappings that tie with the k-th highest score are kept too, so that for k=1 all the
+    # top scoring mappings of a term (e.g. exact matches in several ontologies) are kept rather than one chosen by
+    # ontology name. Pass presorted=True with the output of sort_mappings to take several top-k slices of the same
+    # mappings
+    if not presorted:
+        mappings_df = sort_mappings(mappings_df, id_columns=id_columns)
+    if k_per_ontology is not None:
+        mappings_df = _head_per_group(mappings_df, list(id_columns) + [ONTOLOGY_COL], k_per_ontology, keep_ties)
+    if k is not None:
+        mappings_df = _head_per_group(mappings_df, list(id_columns), k, keep_ties)
+    return mappings_df
+
 
-    # merge the original data frame with the maximum scores data frame on the composite unique identifier and the score
-    top_mappings_df = pd.merge(mappings_df, max_scores, on=[NHANES_VARIABLE_ID_COL, NHANES_TABLE_ID_COL, MAPPING_SCORE_COL])
-    return top_mappings_df
+def _head_per_group(sorted_mappings_df, group_columns, k, keep_ties):
+    groups = sorted_mappings_df.groupby(group_columns, sort=False, observed=True)
+    if not keep_ties:
+        return groups.head(k)
+    score_ranks = groups[MAPPING_SCORE_COL].rank(method="min", ascending=False)
+    return sorted_mappings_df[score_ranks <= k]
 
 
 def flag_mapped_variables(nhanes_variables, mappings):
@@ -153,30 +383,67 @@ def check_mapping(row, mappings):
 
 
 def save_mappings_file(mappings_df, output_file_label, output_file_suffix="", output_folder=MAPPINGS_OUTPUT_FOLDER,
-                       top_mappings_only=False, sort=False):
+                       top_mappings_only=False, sort=False, top_k=1, top_k_per_ontology=None, presorted=False,
+                       keep_ties=True):
     Path(output_folder).mkdir(exist_ok=True, parents=True)
     output_file_name = output_folder + output_file_label + "_mappings"
     if output_file_suffix != "":
         output_file_name += "_" + output_file_suffix
+    if sort and not presorted:
+        mappings_df = sort_mappings(mappings_df)
+        presorted = True
     if top_mappings_only:
-        mappings_df = top_mappings(mappings_df)
-    if sort:
-        mappings_df = mappings_df.sort_values([NHANES_VARIABLE_ID_COL, MAPPING_SCORE_COL], ascending=[True, False])
-    mappings_df.columns = mappings_df.columns.str.replace(' ', '')  # remove spaces from column names
+        mappings_df = top_mappings(mappings_df, k=top_k, k_per_ontology=top_k_per_ontology, presorted=presorted,
+                                   keep_ties=keep_ties)
+    mappings_df = mappings_df.rename(columns=lambda col: col.replace(' ', ''))  # remove spaces from column names
     mappings_df.to_csv(output_file_name + ".tsv", index=False, sep="\t")
 
 
-def save_mappings_subsets(df, nhanes_tables, output_folder, ontology="", top_mappings_only=False):
-    for table in nhanes_tables:
-        subset = df[df[NHANES_TABLE_ID_COL] == table]
+def save_top_mappings_files(mappings_df, output_file_label, top_ks=(1, 3), top_k_per_ontology=None,
+                            output_folder=MAPPINGS_OUTPUT_FOLDER, presorted=False):
+    # sort the mappings once and save one file per k, e.g. 'nhanes_variables_mappings_top1.tsv'. Ties are broken by the
+    # order of sort_mappings, so each file has at most k mappings per source term
+    sorted_mappings = mappings_df if presorted else sort_mappings(mappings_df)
+    for k in top_ks:
+        save_mappings_file(sorted_mappings, output_file_label=output_file_label, output_file_suffix=f"top{k}",
+                           output_folder=output_folder, top_mappings_only=True, top_k=k,
+                           top_k_per_ontology=top_k_per_ontology, presorted=True, keep_ties=False)
+
+
+def save_mappings_subsets(df, nhanes_tables, output_folder, ontology="", top_mappings_only=False, top_k=1,
+                          presorted=False):
+    partitions = [(table, ontology, top_k if top_mappings_only else None) for table in nhanes_tables]
+    save_mappings_partitions(df, partitions=partitions, output_folder=output_folder, presorted=presorted)
+
+
+def save_mappings_partitions(df, partitions, output_folder, presorted=False):
+    # save one mappings file for each (table, ontology, k) partition, where an empty ontology means the mappings to all
+    # ontologies and k=None means all mappings rather than the top-k. The mappings are sorted and grouped by table and
+    # by (table, ontology) only once, regardless of the number of partitions
+    if not presorted:
+        df = sort_mappings(df)
+    table_rows = df.groupby(NHANES_TABLE_ID_COL, sort=False, observed=True).indices
+    table_ontology_rows = df.groupby([NHANES_TABLE_ID_COL, ONTOLOGY_COL], sort=False, observed=True).indices
+    for table, ontology, top_k in partitions:
         if ontology != "":  # limit to mappings to the specified ontology
-            subset = subset[subset[ONTOLOGY_COL] == ontology]
-        save_mappings_file(subset, output_file_label=table, output_file_suffix=ontology, sort=True,
-                           output_folder=output_folder, top_mappings_only=top_mappings_only)
+            rows = table_ontology_rows.get((table, ontology), [])
+        else:
+            rows = table_rows.get(table, [])
+        subset = df.iloc[rows]
+        save_mappings_file(subset, output_file_label=table, output_file_suffix=ontology, sort=True, presorted=True,
+                           output_folder=output_folder, top_mappings_only=(top_k is not None), top_k=top_k)
+
+
+def save_table_mappings_files(mappings_df, output_folder=MAPPINGS_OUTPUT_FOLDER + "tables/", top_k=None,
+                              presorted=False):
+    # save a separate mappings file for each NHANES table that has mappings, e.g. 'tables/DEMO_D_mappings.tsv'
+    tables = mappings_df[NHANES_TABLE_ID_COL].dropna().unique()
+    save_mappings_partitions(mappings_df, partitions=[(table, "", top_k) for table in tables],
+                             output_folder=output_folder, presorted=presorted)
 
 
 def map_nhanes_tables(tables_file=NHANES_TABLES, save_mappings=False, top_mappings_only=False):
-    mappings = map_data(source_df=pd.read_csv(tables_file, sep="\t"),
+    mappings = map_data(source_df=table_schemas.read_table(tables_file),
                         labels_column=NHANES_TABLE_NAME_COL,
                         label_ids_column=NHANES_TABLE_ID_COL)
     if save_mappings:
@@ -185,7 +452,8 @@ def map_nhanes_tables(tables_file=NHANES_TABLES, save_mappings=False, top_mappin
 
 
 def map_nhanes_variables(variables_file=PROCESSED_NHANES_VARIABLES, preprocess=False, save_mappings=False,
-                         top_mappings_only=False, variables_file_col_separator="\t", flag_mapped=False):
+                         top_mappings_only=False, variables_file_col_separator="\t", flag_mapped=False, top_ks=(),
+                         save_table_files=False, chunk_size=MAPPING_CHUNK_SIZE, checkpoint_folder=MAPPING_CHECKPOINTS_FOLDER + "nhanes_variables"):
     labels_column = NHANES_VARIABLE_LABEL_COL
     tags_column = ""
     if preprocess:
@@ -196,36 +464,47 @@ def map_nhanes_variables(variables_file=PROCESSED_NHANES_VARIABLES, preprocess=F
         labels_column = NHANES_VARIABLE_LABEL_PROCESSED_COL
         tags_column = "Tags"
     else:
-        input_df = pd.read_csv(variables_file, sep=variables_file_col_separator, lineterminator="\n")
+        input_df = table_schemas.read_table(variables_file, sep=variables_file_col_separator, lineterminator="\n")
 
     mappings = map_data_with_composite_ids(df=input_df,
                                            labels_column=labels_column,
                                            variable_id_column=NHANES_VARIABLE_ID_COL,
                                            table_id_column=NHANES_TABLE_ID_COL,
-                                           tags_column=tags_column)
+                                           tags_column=tags_column,
+                                           chunk_size=chunk_size,
+                                           checkpoint_folder=checkpoint_folder)
     mappings = remove_empty_duplicates(mappings)
     mappings = readd_oral_health_mappings(mappings)
     if save_mappings:
-        save_mappings_file(mappings, output_file_label="nhanes_variables", top_mappings_only=top_mappings_only, sort=True)
+        sorted_mappings = sort_mappings(mappings)
+        save_mappings_file(sorted_mappings, output_file_label="nhanes_variables", top_mappings_only=top_mappings_only,
+                           sort=True, presorted=True)
+        if top_ks:  # additionally save the top-k mappings of each variable, e.g. for top_ks=(1, 3)
+            save_top_mappings_files(sorted_mappings, output_file_label="nhanes_variables", top_ks=top_ks,
+                                    presorted=True)
+        if save_table_files:  # additionally save the mappings of the variables in each table to a separate file
+            save_table_mappings_files(sorted_mappings, top_k=(1 if top_mappings_only else None), presorted=True)
     if flag_mapped:
         updated_nhanes_variables = flag_mapped_variables(input_df, mappings)
         updated_nhanes_variables = updated_nhanes_variables.drop(columns=[NHANES_VARIABLE_COMBINED_ID_COL])
         updated_nhanes_variables.to_csv(variables_file, sep="\t", index=False, quoting=csv.QUOTE_NONNUMERIC)
+    if chunk_size is not None and checkpoint_folder:  # all chunks are merged and saved, so the checkpoints are done
+        shutil.rmtree(checkpoint_folder, ignore_errors=True)
     return mappings
 
 
 def remove_empty_duplicates(df):
-    filter_df = df.loc[pd.to_numeric(df["Mapping Score"]) == 0]
+    filter_df = df.loc[df[MAPPING_SCORE_COL] == 0]
     filter_df = filter_df.drop_duplicates(subset=['Variable', 'Table'], keep='last')
     filter_df = filter_df.assign(Ontology="All")
 
-    new_df = df.loc[pd.to_numeric(df["Mapping Score"]) > 0]
+    new_df = df.loc[df[MAPPING_SCORE_COL] > 0]
     final_df = pd.concat([new_df, filter_df], ignore_index=True)
 
     return final_df
 
 def readd_oral_health_mappings(df):
-    oral_health_mappings_df = pd.read_csv(NHANES_ORAL_HEALTH_MAPPINGS, sep='\t')
+    oral_health_mappings_df = table_schemas.read_table(NHANES_ORAL_HEALTH_MAPPINGS)
     new_df = pd.DataFrame(columns=df.columns)
     for index, row in oral_health_mappings_df.iterrows():
         new_row = [row["Variable"], row["Table"], \
@@ -235,26 +514,26 @@ def readd_oral_health_mappings(df):
         df = df.drop(row_index)
         new_df.loc[len(new_df.index)] = new_row
     df = pd.concat([df, new_df], ignore_index=True)
-    return df
+    # restore the column types lost in the concatenation, except for the tags, which are lists in the re-added rows
+    dtypes = {column: dtype for column, dtype in table_schemas.MAPPINGS_DTYPES.items() if column != "Tags"}
+    return table_schemas.apply_dtypes(df, dtypes)
 
 def map_nhanes_metadata(create_ontology_cache=False, preprocess_labels=False, save_mappings=False,
-                        top_mappings_only=False, flag_mapped=False):
+                        top_mappings_only=False, flag_mapped=False, top_ks=(), save_table_files=False):
     if create_ontology_cache:
         text2term.cache_ontology_set(ontology_registry_path=TARGET_ONTOLOGIES)
     nhanes_table_mappings = map_nhanes_tables(save_mappings=save_mappings)
     nhanes_variable_mappings = map_nhanes_variables(preprocess=preprocess_labels, save_mappings=save_mappings,
-                                                    top_mappings_only=top_mappings_only, flag_mapped=flag_mapped)
+                                                    top_mappings_only=top_mappings_only, flag_mapped=flag_mapped,
+                                                    top_ks=top_ks, save_table_files=save_table_files)
     return nhanes_table_mappings, nhanes_variable_mappings
 
 
 def save_oral_health_tables(mappings_df):
     hdms_output_folder = MAPPINGS_OUTPUT_FOLDER + "oral-health-tables/"
-    save_mappings_subsets(mappings_df, output_folder=hdms_output_folder,
-                          nhanes_tables=["OHXREF_C", "OHXDEN_C"], top_mappings_only=True)
-    save_mappings_subsets(mappings_df, output_folder=hdms_output_folder,
-                          nhanes_tables=["OHXPRU_C", "OHXPRL_C"], top_mappings_only=False)
-    save_mappings_subsets(mappings_df, output_folder=hdms_output_folder,
-                          nhanes_tables=["OHXPRU_C", "OHXPRL_C", "OHXREF_C", "OHXDEN_C"], ontology="OHD")
+    partitions = [("OHXREF_C", "", 1), ("OHXDEN_C", "", 1), ("OHXPRU_C", "", None), ("OHXPRL_C", "", None)]
+    partitions += [(table, "OHD", None) for table in ["OHXPRU_C", "OHXPRL_C", "OHXREF_C", "OHXDEN_C"]]
+    save_mappings_partitions(mappings_df, partitions=partitions, output_folder=hdms_output_folder)
 
 
 if __name__ == "__main__":
@@ -263,4 +542,6 @@ if __name__ == "__main__":
                                                             preprocess_labels=True,
                                                             top_mappings_only=True,
                                                             save_mappings=True,
+                                                            top_ks=(1, 3),
+                                                            save_table_files=True,
                                                             flag_mapped=True)
@@ -1,60 +1,169 @@
 import os
 import gzip
 import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import sqlite3
 import urllib.request
 import bioregistry
 import pandas as pd
 from collections import deque
+from functools import lru_cache
+from ontology_hierarchy import OntologyHierarchy
+from table_schemas import read_table
 
-__version__ = "0.11.5"
+__version__ = "0.16.0"
 
 SUBJECT_COL = "Subject"
 OBJECT_COL = "Object"
 IRI_COL = "IRI"
 ONTOLOGY_COL = "Ontology"
 DISEASE_LOCATION_COL = "DiseaseLocation"
+STATEMENTS_INDEX = "statements_predicate_subject_idx"
+DISEASE_LOCATION_TABLES = ("owl_subclass_of_some_values_from", "owl_subclass_of_only_values_from")
 IRI_PRIORITY_LIST = ["obofoundry", "default", "bioregistry"]
+LOOKUP_CACHE_SIZE = 2 ** 18  # maximum number of per-term disease location lookups cached per database
 
 ONTOLOGY_TABLES_OUTPUT_FOLDER = os.path.join("..", "ontology-tables")
 DATABASE_OUTPUT_FOLDER = os.path.join("..", "ontology-db")
+HIERARCHIES_FOLDER = "hierarchies"  # subfolder of the tables output folder
+SHARDS_FOLDER = "shards"  # subfolder of the tables output folder, removed once the shards are merged
+
+# Names of the tables extracted from each ontology, in the order get_semsql_tables_for_ontology returns them. When all
+# ontologies go into a single table, each table is saved to a file named 'ontology_<table>.tsv'
+ONTOLOGY_TABLES = ["edges", "entailed_edges", "labels", "dbxrefs", "synonyms"]
+
+
+class SemanticSQLDatabase:
+    # Data access layer for a SemanticSQL database. Queries are parameterized (so the sqlite3 module reuses their
+    # prepared statements), select only the columns that are needed, and return lists of tuples. The per-term disease
+    # location lookups made when traversing the class hierarchy are memoized in an LRU cache
+
+    def __init__(self, db_file, cache_size=LOOKUP_CACHE_SIZE):
+        self.db_file = db_file
+        self.connection = sqlite3.connect(db_file, cached_statements=256)
+        self.disease_locations = lru_cache(maxsize=cache_size)(self._get_disease_locations)
+
+    def query(self, sql, parameters=()):
+        return self.connection.execute(sql, parameters).fetchall()
+
+    def execute(self, sql, parameters=()):
+        self.connection.execute(sql, parameters)
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.disease_locations.cache_clear()
+        self.connection.close()
+
+    def _get_disease_locations(self, subject, table, predicate):
+        # Get the named disease locations stated for the given term via the given predicate in the given view, which
+        # must be one of the restriction views in DISEASE_LOCATION_TABLES
+        if table not in DISEASE_LOCATION_TABLES:
+            raise ValueError("Unsupported disease location table: " + table)
+        locations = self.query(f"SELECT object FROM {table} WHERE predicate=? AND subject=? "
+                               "AND substr(object, 1, 1) != '_'", (predicate, subject))
+        return tuple(location for (location,) in locations)
 
 
 def get_semsql_tables_for_ontologies(ontologies,
                                      tables_output_folder=ONTOLOGY_TABLES_OUTPUT_FOLDER,
                                      db_output_folder=DATABASE_OUTPUT_FOLDER,
                                      save_tables=False, single_table_for_all_ontologies=False,
-                                     include_disease_locations=False):
-    all_edges = all_entailed_edges = all_labels = all_dbxrefs = all_synonyms = pd.DataFrame()
+                                     include_disease_locations=False, save_hierarchies=False):
+    # Get the edges, entailed edges, labels, dbxrefs and synonyms tables of all the given ontologies as data frames.
+    # With single_table_for_all_ontologies=True, the tables are combined (see save_semsql_tables_for_ontologies) and
+    # saved to the tables output folder if save_tables=True, or otherwise to a temporary folder that is removed before
+    # returning. With single_table_for_all_ontologies=False, the tables of each ontology are saved separately and the
+    # returned data frames are empty
+    if not single_table_for_all_ontologies:
+        save_semsql_tables_for_ontologies(ontologies, tables_output_folder=tables_output_folder,
+                                          db_output_folder=db_output_folder, single_table_for_all_ontologies=False,
+                                          include_disease_locations=include_disease_locations,
+                                          save_hierarchies=save_hierarchies)
+        return tuple(pd.DataFrame() for _ in ONTOLOGY_TABLES)
+    combined_tables_folder = tables_output_folder if save_tables else tempfile.mkdtemp(prefix="ontology-tables-")
+    try:
+        table_files = save_semsql_tables_for_ontologies(ontologies, tables_output_folder=tables_output_folder,
+                                                        db_output_folder=db_output_folder,
+                                                        include_disease_locations=include_disease_locations,
+                                                        save_hierarchies=save_hierarchies,
+                                                        combined_tables_folder=combined_tables_folder)
+        return load_ontology_tables(table_files)
+    finally:
+        if not save_tables:
+            shutil.rmtree(combined_tables_folder, ignore_errors=True)
+
+
+def save_semsql_tables_for_ontologies(ontologies,
+                                      tables_output_folder=ONTOLOGY_TABLES_OUTPUT_FOLDER,
+                                      db_output_folder=DATABASE_OUTPUT_FOLDER,
+                                      single_table_for_all_ontologies=True, include_disease_locations=False,
+                                      save_hierarchies=False, combined_tables_folder=None):
+    # Save the tables of all the given ontologies and return the paths of the combined tables, in the order of
+    # ONTOLOGY_TABLES. The tables of each ontology are saved as shards as soon as they are extracted, and the shards are
+    # concatenated at the end, so only one ontology's tables are held in memory at a time. The combined tables are
+    # saved to combined_tables_folder (by default, the tables output folder), and the hierarchies to the tables output
+    # folder. With single_table_for_all_ontologies=False, the tables of each ontology are saved separately by
+    # get_semsql_tables_for_ontology instead, and all returned paths are None
+    if combined_tables_folder is None:
+        combined_tables_folder = tables_output_folder
+    shards_folder = os.path.join(combined_tables_folder, SHARDS_FOLDER)
+    shard_files = {table: [] for table in ONTOLOGY_TABLES}
     for ontology in ontologies:
         ontology_url = "https://s3.amazonaws.com/bbop-sqlite/" + ontology.lower() + ".db.gz"
-        edges, entailed_edges, labels, dbxrefs, synonyms, version = \
-            get_semsql_tables_for_ontology(ontology_url=ontology_url,
-                                           ontology_name=ontology,
-                                           db_output_folder=db_output_folder,
-                                           save_tables=(not single_table_for_all_ontologies),
-                                           include_disease_locations=include_disease_locations)
+        ontology_tables = get_semsql_tables_for_ontology(ontology_url=ontology_url,
+                                                         ontology_name=ontology,
+                                                         db_output_folder=db_output_folder,
+                                                         save_tables=(not single_table_for_all_ontologies),
+                                                         include_disease_locations=include_disease_locations,
+                                                         tables_output_folder=tables_output_folder,
+                                                         save_hierarchy=save_hierarchies)[:len(ONTOLOGY_TABLES)]
         if single_table_for_all_ontologies:
-            labels[ONTOLOGY_COL] = edges[ONTOLOGY_COL] = entailed_edges[ONTOLOGY_COL] = dbxrefs[ONTOLOGY_COL] = \
-                synonyms[ONTOLOGY_COL] = ontology
-            all_labels = pd.concat([all_labels, labels])
-            all_edges = pd.concat([all_edges, edges])
-            all_entailed_edges = pd.concat([all_entailed_edges, entailed_edges])
-            all_dbxrefs = pd.concat([all_dbxrefs, dbxrefs])
-            all_synonyms = pd.concat([all_synonyms, synonyms])
-
-    if save_tables and single_table_for_all_ontologies:
-        save_table(all_labels, "ontology_labels.tsv", tables_output_folder)
-        save_table(all_edges, "ontology_edges.tsv", tables_output_folder)
-        save_table(all_entailed_edges, "ontology_entailed_edges.tsv", tables_output_folder)
-        save_table(all_dbxrefs, "ontology_dbxrefs.tsv", tables_output_folder)
-        save_table(all_synonyms, "ontology_synonyms.tsv", tables_output_folder)
-    return all_edges, all_entailed_edges, all_labels, all_dbxrefs, all_synonyms
+            for table, table_df in zip(ONTOLOGY_TABLES, ontology_tables):
+                table_df[ONTOLOGY_COL] = ontology
+                shard_file = ontology.lower() + "_" + table + ".tsv"
+                save_table(table_df, shard_file, shards_folder)
+                shard_files[table].append(os.path.join(shards_folder, shard_file))
+        del ontology_tables
+
+    if not single_table_for_all_ontologies:
+        return tuple(None for _ in ONTOLOGY_TABLES)
+    output_files = [os.path.join(combined_tables_folder, "ontology_" + table + ".tsv") for table in ONTOLOGY_TABLES]
+    # the tables are independent, so they are merged concurrently; the shards of each table are merged in order
+    with ThreadPoolExecutor(max_workers=len(ONTOLOGY_TABLES)) as executor:
+        list(executor.map(merge_table_shards, [shard_files[table] for table in ONTOLOGY_TABLES], output_files))
+    shutil.rmtree(shards_folder, ignore_errors=True)
+    return tuple(output_files)
+
+
+def load_ontology_tables(table_files):
+    # Load the given ontology table files, such as those returned by save_semsql_tables_for_ontologies, as data frames
+    return tuple(read_table(table_file, low_memory=False) for table_file in table_files)
+
+
+def merge_table_shards(shard_files, output_file):
+    # Concatenate the given TSV files, which must have the same header, into the output file without parsing them. The
+    # output is written to a temporary file first so that an interrupted merge does not leave a partial table behind
+    header = None
+    with open(output_file + ".tmp", "wb") as output:
+        for shard_file in shard_files:
+            with open(shard_file, "rb") as shard:
+                shard_header = shard.readline()
+                if header is None:
+                    header = shard_header
+                    output.write(header)
+                elif shard_header != header:
+                    raise ValueError(f"The header of {shard_file} differs from that of {shard_files[0]}")
+                shutil.copyfileobj(shard, output, 1024 * 1024)
+    os.replace(output_file + ".tmp", output_file)
+    return output_file
 
 
 def get_semsql_tables_for_ontology(ontology_url, ontology_name, tables_output_folder=ONTOLOGY_TABLES_OUTPUT_FOLDER,
                                    db_output_folder=DATABASE_OUTPUT_FOLDER, save_tables=False,
-                                   include_disease_locations=False):
+                                   include_disease_locations=False, save_hierarchy=False):
     db_file = os.path.join(db_output_folder, ontology_name.lower() + ".db")
     db_gz_file = db_file + ".gz"
     if not os.path.exists(db_output_folder):
@@ -64,30 +173,40 @@ def get_semsql_tables_for_ontology(ontology_url, ontology_name, tables_output_fo
     with gzip.open(db_gz_file, "rb") as file_in, open(db_file, "wb") as file_out:
         shutil.copyfileobj(file_in, file_out)
     print(f"Generating tables for {ontology_name}...")
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    if include_disease_locations:
-        _add_views(cursor)  # add database views needed for disease location retrieval
-    edges_df = _get_edges_table(cursor)
-    entailed_edges_df = _get_entailed_edges_table(cursor)
-    labels_df = _get_labels_table(cursor, ontology_name=ontology_name, include_disease_locations=include_disease_locations)
-    dbxrefs_df = _get_db_cross_references_table(cursor)
-    synonyms_df = _get_synonyms_table(cursor)
-    onto_version = _get_ontology_version(cursor)
+    db = SemanticSQLDatabase(db_file)
+    had_statistics = True
+    try:
+        # temporary index to speed up the label, synonym and dbxref queries
+        had_statistics = _create_statements_index(db)
+        if include_disease_locations:
+            _add_views(db)  # add database views needed for disease location retrieval
+        edges_df = _get_edges_table(db)
+        entailed_edges_df = _get_entailed_edges_table(db)
+        labels_df = _get_labels_table(db, ontology_name=ontology_name,
+                                      include_disease_locations=include_disease_locations)
+        dbxrefs_df = _get_db_cross_references_table(db)
+        synonyms_df = _get_synonyms_table(db)
+        onto_version = _get_ontology_version(db)
+    finally:
+        # remove the temporary index, and the statistics table if ANALYZE created it, even if the extraction fails
+        _drop_statements_index(db, drop_statistics=not had_statistics)
+        db.close()
     if onto_version != "":
         print(f"\t{ontology_name} version: {onto_version}")
-    cursor.close()
-    conn.close()
     if save_tables:
         save_table(labels_df, ontology_name.lower() + "_labels.tsv", tables_output_folder)
         save_table(edges_df, ontology_name.lower() + "_entailed_edges.tsv", tables_output_folder)
         save_table(entailed_edges_df, ontology_name.lower() + "_edges.tsv", tables_output_folder)
         save_table(dbxrefs_df, ontology_name.lower() + "_dbxrefs.tsv", tables_output_folder)
         save_table(synonyms_df, ontology_name.lower() + "_synonyms.tsv", tables_output_folder)
+    if save_hierarchy:
+        # save the asserted class hierarchy as a memory-mappable bundle of arrays, see ontology_hierarchy.py
+        hierarchy = OntologyHierarchy.from_edges_df(edges_df)
+        hierarchy.save(os.path.join(tables_output_folder, HIERARCHIES_FOLDER, ontology_name.lower()))
     return edges_df, entailed_edges_df, labels_df, dbxrefs_df, synonyms_df, onto_version
 
 
-def _add_views(cursor):
+def _add_views(db):
     # In EFO, some disease locations are expressed in universal restrictions—for example:
     # pancreatitis (EFO:0000278) has_disease_location only pancreas
     # Currently there are no views in the SemanticSQL build of EFO for universal restrictions, only for existential ones
@@ -98,7 +217,7 @@ def _add_views(cursor):
                                        "FROM statements AS onProperty, statements AS f " + \
                                        "WHERE onProperty.predicate = 'owl:onProperty' AND onProperty.subject=f.subject " + \
                                        "AND f.predicate='owl:allValuesFrom';"
-    cursor.execute(create_owl_only_values_from_view)
+    db.execute(create_owl_only_values_from_view)
 
     # Use the view just created to add another convenience view that mimics the existing view
     # 'owl_subclass_of_some_values_from', but again, for universal restrictions instead
@@ -106,86 +225,87 @@ def _add_views(cursor):
                                                    "SELECT subClassOf.stanza, subClassOf.subject, svf.on_property AS predicate, svf.filler AS object " + \
                                                    "FROM statements AS subClassOf, owl_only_values_from AS svf " + \
                                                    "WHERE subClassOf.predicate = 'rdfs:subClassOf' AND svf.id=subClassOf.object;"
-    cursor.execute(create_owl_subclass_of_only_values_from_view)
+    db.execute(create_owl_subclass_of_only_values_from_view)
 
 
-def _get_ontology_version(cursor):
-    cursor.execute("SELECT `value` FROM statements WHERE predicate='owl:versionInfo'")
-    ontology_version = cursor.fetchall()
+def _get_ontology_version(db):
+    ontology_version = db.query("SELECT value FROM statements WHERE predicate='owl:versionInfo'")
     if len(ontology_version) > 0:
         return ontology_version.pop()[0]
     return ""
 
 
-def _get_edges_table(cursor):
-    cursor.execute("SELECT * FROM edge WHERE predicate='rdfs:subClassOf'")
-    edge_columns = [x[0] for x in cursor.description]
-    edge_data = cursor.fetchall()
-    edges_df = pd.DataFrame(edge_data, columns=edge_columns)
-    edges_df = edges_df.drop(columns=["predicate"])
-    edges_df = edges_df.rename(columns={'object': OBJECT_COL, 'subject': SUBJECT_COL})
-    edges_df = edges_df.drop_duplicates()
+def _get_edges_table(db):
+    edge_data = db.query("SELECT DISTINCT subject, object FROM edge WHERE predicate='rdfs:subClassOf'")
+    edges_df = pd.DataFrame(edge_data, columns=[SUBJECT_COL, OBJECT_COL])
     edges_df = fix_identifiers(edges_df, columns=[SUBJECT_COL, OBJECT_COL])
     return edges_df
 
 
-def _get_entailed_edges_table(cursor):
-    cursor.execute("SELECT * FROM entailed_edge WHERE predicate='rdfs:subClassOf'")
-    entailed_edge_columns = [x[0] for x in cursor.description]
-    entailed_edge_data = cursor.fetchall()
-    entailed_edges_df = pd.DataFrame(entailed_edge_data, columns=entailed_edge_columns)
-    entailed_edges_df = entailed_edges_df.drop(columns=["predicate"])
-    entailed_edges_df = entailed_edges_df.rename(columns={'object': OBJECT_COL, 'subject': SUBJECT_COL})
-    entailed_edges_df = entailed_edges_df.drop_duplicates()
+def _get_entailed_edges_table(db):
+    entailed_edge_data = db.query("SELECT DISTINCT subject, object FROM entailed_edge "
+                                  "WHERE predicate='rdfs:subClassOf'")
+    entailed_edges_df = pd.DataFrame(entailed_edge_data, columns=[SUBJECT_COL, OBJECT_COL])
     entailed_edges_df = fix_identifiers(entailed_edges_df, columns=[SUBJECT_COL, OBJECT_COL])
     return entailed_edges_df
 
 
-def _get_labels_table(cursor, ontology_name, include_disease_locations=False):
-    # Get rdfs:label statements for ontology classes that are not deprecated
-    labels_query = "SELECT * FROM statements WHERE predicate='rdfs:label' AND subject IN " + \
-                   "(SELECT subject FROM statements WHERE predicate='rdf:type' AND object='owl:Class') " + \
-                   "AND subject NOT IN " + \
-                   "(SELECT subject FROM statements WHERE predicate='owl:deprecated' AND value='true')"
-    cursor.execute(labels_query)
-    labels_columns = [x[0] for x in cursor.description]
-    labels_data = cursor.fetchall()
-    labels_df = pd.DataFrame(labels_data, columns=labels_columns)
-    labels_df = labels_df.drop(columns=["stanza", "predicate", "object", "datatype", "language", "graph"])
-    labels_df = labels_df.rename(columns={'value': OBJECT_COL, 'subject': SUBJECT_COL})
-    labels_df = labels_df.drop_duplicates(subset=[SUBJECT_COL])  # remove all but one label for each subject/term
-    labels_df = labels_df[labels_df[SUBJECT_COL].str.startswith("_:") == False]  # remove blank nodes
+def _create_statements_index(db):
+    # The SemanticSQL builds do not index the statements table on (predicate, subject), which makes every correlated
+    # lookup below a full scan of the table. The index is dropped again once the tables have been extracted. Returns
+    # whether the database already had a statistics table (sqlite_stat1) before ANALYZE, which creates it if missing
+    had_statistics = len(db.query("SELECT name FROM sqlite_master WHERE type='table' AND name='sqlite_stat1'")) > 0
+    db.execute(f"CREATE INDEX IF NOT EXISTS {STATEMENTS_INDEX} ON statements(predicate, subject)")
+    db.execute("PRAGMA analysis_limit=1000")
+    db.execute("ANALYZE statements")
+    return had_statistics
+
+
+def _drop_statements_index(db, drop_statistics=False):
+    # Drop the temporary index and, if ANALYZE created it, the statistics table
+    db.execute(f"DROP INDEX IF EXISTS {STATEMENTS_INDEX}")
+    if drop_statistics:
+        db.execute("DROP TABLE IF EXISTS sqlite_stat1")
+    db.commit()
+
+
+def _get_labels_table(db, ontology_name, include_disease_locations=False):
+    # Get one rdfs:label statement for each ontology class that is not deprecated and is not a blank node. Labels
+    # without a language tag or tagged as English are preferred over labels in other languages
+    labels_query = "SELECT l.subject, COALESCE(MIN(CASE WHEN l.language IS NULL OR l.language='en' " + \
+                   "THEN l.value END), MIN(l.value)) AS value FROM statements AS l " + \
+                   "WHERE l.predicate='rdfs:label' AND substr(l.subject, 1, 2) != '_:' " + \
+                   "AND EXISTS (SELECT 1 FROM statements AS t WHERE t.predicate='rdf:type' " + \
+                   "AND t.subject=l.subject AND t.object='owl:Class') " + \
+                   "AND NOT EXISTS (SELECT 1 FROM statements AS d WHERE d.predicate='owl:deprecated' " + \
+                   "AND d.subject=l.subject AND d.value='true') " + \
+                   "GROUP BY l.subject"
+    labels_data = db.query(labels_query)
+    labels_df = pd.DataFrame(labels_data, columns=[SUBJECT_COL, OBJECT_COL])
     labels_df = fix_identifiers(labels_df, columns=[SUBJECT_COL])
     labels_df[OBJECT_COL] = labels_df[OBJECT_COL].str.strip()
     labels_df[IRI_COL] = labels_df[SUBJECT_COL].apply(get_iri)
     if include_disease_locations:
+        # the superclasses of each term are looked up in an in-memory copy of the asserted class hierarchy
+        hierarchy = OntologyHierarchy.from_semsql(db.db_file)
         labels_df[DISEASE_LOCATION_COL] = labels_df[SUBJECT_COL].apply(
-            _get_disease_location_for_term, connection=cursor.connection, ontology=ontology_name)
+            _get_disease_location_for_term, db=db, hierarchy=hierarchy, ontology=ontology_name)
     return labels_df
 
 
-def _get_db_cross_references_table(cursor):
-    cursor.execute("SELECT * FROM has_dbxref_statement")
-    db_xrefs_columns = [x[0] for x in cursor.description]
-    db_xrefs_data = cursor.fetchall()
-    db_xrefs = pd.DataFrame(db_xrefs_data, columns=db_xrefs_columns)
-    db_xrefs = db_xrefs.drop(columns=["stanza", "predicate", "object", "datatype", "language", "graph"])
-    db_xrefs = db_xrefs.rename(columns={'value': OBJECT_COL, 'subject': SUBJECT_COL})
-    db_xrefs = db_xrefs.drop_duplicates()
-    db_xrefs = db_xrefs[db_xrefs[SUBJECT_COL].str.startswith("_:") == False]  # remove blank nodes
+def _get_db_cross_references_table(db):
+    db_xrefs_query = "SELECT DISTINCT subject, value FROM has_dbxref_statement WHERE substr(subject, 1, 2) != '_:'"
+    db_xrefs_data = db.query(db_xrefs_query)
+    db_xrefs = pd.DataFrame(db_xrefs_data, columns=[SUBJECT_COL, OBJECT_COL])
     db_xrefs = fix_identifiers(db_xrefs, columns=[SUBJECT_COL])
     return db_xrefs
 
 
-def _get_synonyms_table(cursor):
-    cursor.execute("SELECT * FROM has_exact_synonym_statement")
-    synonyms_df_columns = [x[0] for x in cursor.description]
-    synonyms_df_data = cursor.fetchall()
-    synonyms_df = pd.DataFrame(synonyms_df_data, columns=synonyms_df_columns)
-    synonyms_df = synonyms_df.drop(columns=["stanza", "predicate", "object", "datatype", "language", "graph"])
-    synonyms_df = synonyms_df.rename(columns={'value': OBJECT_COL, 'subject': SUBJECT_COL})
-    synonyms_df = synonyms_df.drop_duplicates()
-    synonyms_df = synonyms_df[synonyms_df[SUBJECT_COL].str.startswith("_:") == False]  # remove blank nodes
+def _get_synonyms_table(db):
+    synonyms_query = "SELECT DISTINCT subject, value FROM has_exact_synonym_statement " + \
+                     "WHERE substr(subject, 1, 2) != '_:'"
+    synonyms_df_data = db.query(synonyms_query)
+    synonyms_df = pd.DataFrame(synonyms_df_data, columns=[SUBJECT_COL, OBJECT_COL])
     synonyms_df = fix_identifiers(synonyms_df, columns=[SUBJECT_COL])
     return synonyms_df
 
@@ -235,45 +355,32 @@ def _get_curie(term):
     return curie
 
 
-def _get_disease_locations(connection, subject, table, ontology):
+def _get_disease_location_predicate(ontology):
     if ontology == "EFO":
-        predicate = "EFO:0000784"
+        return "EFO:0000784"
     elif ontology == "NCIT":
-        predicate = "NCIT:R101"
+        return "NCIT:R101"
     else:
         # default to RO:0001025 ('located in') from Relations Ontology
-        predicate = "RO:0001025"
-    disease_location_query = f"SELECT object FROM {table} " \
-                             f"WHERE predicate='{predicate}' AND subject='{subject}'"
-    locations = pd.read_sql_query(disease_location_query, connection)
-    locations = locations[~locations['object'].str.startswith("_")]  # remove rows where locations are blank nodes
-    return locations["object"].tolist()
+        return "RO:0001025"
 
 
-def _get_parents(connection, subject):
-    parents_query = f"SELECT object FROM edge WHERE subject='{subject}' AND predicate='rdfs:subClassOf'"
-    parents = pd.read_sql_query(parents_query, connection)
-    parents = parents[~parents['object'].str.startswith("_")]  # remove blank nodes
-    return parents["object"].tolist()
-
-
-def _get_disease_location_for_term(subject, connection, ontology):
+def _get_disease_location_for_term(subject, db, hierarchy, ontology):
+    predicate = _get_disease_location_predicate(ontology)
     queue = deque([subject])  # Initialize a queue to perform a BFS
+    visited = {subject}
     while queue:
         current_term = queue.popleft()
-        # first check if a location is stated in existential restrictions (most common)
-        locations = _get_disease_locations(connection, current_term, "owl_subclass_of_some_values_from", ontology)
-        if locations:
-            return locations[0] if len(locations) == 1 else ",".join(locations)
-        else:
-            # then check if a location is stated in universal restrictions
-            locations = _get_disease_locations(connection, current_term, "owl_subclass_of_only_values_from", ontology)
+        # first check if a location is stated in existential restrictions (most common), then in universal restrictions
+        for table in DISEASE_LOCATION_TABLES:
+            locations = db.disease_locations(current_term, table, predicate)
             if locations:
                 return locations[0] if len(locations) == 1 else ",".join(locations)
-            else:
-                # otherwise check if a parent has a stated disease location
-                parents = [parent for parent in _get_parents(connection, current_term) if parent != "owl:Thing"]
-                queue.extend(parents)
+        # otherwise check if a parent has a stated disease location
+        parents = [parent for parent in hierarchy.parents(current_term)
+                   if parent != "owl:Thing" and parent not in visited]
+        visited.update(parents)
+        queue.extend(parents)
     return pd.NA
 
 
@@ -285,5 +392,5 @@ def save_table(df, output_filename, tables_output_folder):
 
 
 if __name__ == "__main__":
-    get_semsql_tables_for_ontologies(ontologies=["EFO", "FOODON", "NCIT"], save_tables=True,
-                                     single_table_for_all_ontologies=True, include_disease_locations=True)
+    save_semsql_tables_for_ontologies(ontologies=["EFO", "FOODON", "NCIT"], include_disease_locations=True,
+                                      save_hierarchies=True)
@@ -1,20 +1,40 @@
-import pandas as pd
+import argparse
+import json
+import pathlib
+import re
 import sqlite3
+import sys
 import os
 
-__version__ = "0.4.0"
+# pandas is imported only by the functions that return data frames, so that command-line searches start quickly
+
+__version__ = "0.5.2"
 
 ONTOLOGY_MAPPINGS_TABLE = 'ontology_mappings'
+DATABASE_FILE = os.path.join("..", "nhanes_metadata.db")
+ONTOLOGY_TERMS_FTS_TABLE = 'ontology_terms_fts'
+NHANES_VARIABLES_FTS_TABLE = 'nhanes_variables_fts'
+MAX_TEXT_SEARCH_TERMS = 20
 
 
 def import_table_to_db(sql_connection, table_file, table_name, table_columns):
+    from table_schemas import read_table
     db_cursor = sql_connection.cursor()
     db_cursor.execute('''CREATE TABLE IF NOT EXISTS ''' + table_name + ''' (''' + table_columns + ''')''')
-    data_frame = pd.read_csv(table_file, sep="\t", low_memory=False)
+    data_frame = read_table(table_file, score_dtype="float64", low_memory=False)
     data_frame.to_sql(table_name, sql_connection, if_exists='replace', index=False)
 
 
 def resources_annotated_with_term(db_cursor, search_terms, include_subclasses=True, direct_subclasses_only=False):
+    import pandas as pd
+    results_columns, results = search_resources(db_cursor, search_terms, include_subclasses=include_subclasses,
+                                                direct_subclasses_only=direct_subclasses_only)
+    return pd.DataFrame(results, columns=results_columns)
+
+
+def search_resources(db_cursor, search_terms, include_subclasses=True, direct_subclasses_only=False):
+    # Get the column names and the rows (as tuples sorted by variable) of the mappings to any of the given search
+    # terms or, optionally, to their direct or indirect subclasses
     if include_subclasses:
         if direct_subclasses_only:
             ontology_table = "ontology_edges"
@@ -23,32 +43,28 @@ def resources_annotated_with_term(db_cursor, search_terms, include_subclasses=Tr
     else:
         ontology_table = "ontology_edges"
 
-    query = '''SELECT DISTINCT 
+    search_terms = list(search_terms)
+    placeholders = ",".join("?" * len(search_terms))
+    select_clause = '''SELECT DISTINCT 
                     m.Variable, 
                     m.`Table`, 
                     m.SourceTerm, 
                     m.MappedTermLabel, 
                     m.MappedTermCURIE, 
                     m.MappingScore
-                FROM `''' + ONTOLOGY_MAPPINGS_TABLE + '''` m
-                LEFT JOIN ''' + ontology_table + ''' ee ON (m.MappedTermCURIE = ee.Subject)'''
-    index = 0
-    where_clause = "\nWHERE ("
-    for term in search_terms:
-        if index == 0:
-            where_clause += "m.MappedTermCURIE = \'" + term + "\'"
-        else:
-            where_clause += " OR m.MappedTermCURIE = \'" + term + "\'"
-        if include_subclasses:
-            where_clause += " OR ee.Object = \'" + term + "\'"
-        index += 1
-    query += where_clause + ")"
+                FROM `''' + ONTOLOGY_MAPPINGS_TABLE + '''` m'''
+    query = select_clause + "\nWHERE m.MappedTermCURIE IN (" + placeholders + ")"
+    parameters = search_terms
+    if include_subclasses:
+        # a union of two indexed lookups, rather than a join with an OR condition that requires a full scan
+        query += "\nUNION\n" + select_clause + "\nJOIN " + ontology_table + " ee ON (m.MappedTermCURIE = ee.Subject)" + \
+                 "\nWHERE ee.Object IN (" + placeholders + ")"
+        parameters = search_terms + search_terms
+    query += "\nORDER BY 1"
 
-    results = db_cursor.execute(query).fetchall()
+    results = db_cursor.execute(query, parameters).fetchall()
     results_columns = [x[0] for x in db_cursor.description]
-    results_df = pd.DataFrame(results, columns=results_columns)
-    results_df = results_df.sort_values(by=['Variable'])
-    return results_df
+    return results_columns, results
 
 
 def do_example_queries(db_cursor, search_terms=('EFO:0009605', 'EFO:0005741')):  # EFO:0009605 'pancreas disease'
@@ -72,15 +88,136 @@ def do_example_queries(db_cursor, search_terms=('EFO:0009605', 'EFO:0005741')):
         print(df3.head().to_string() + "\n")
 
 
-if __name__ == '__main__':
-    connection = sqlite3.connect(os.path.join("..", "nhanes_metadata.db"))
-    cursor = connection.cursor()
+def resources_matching_text(db_cursor, text, include_subclasses=True, direct_subclasses_only=False,
+                            max_ontology_terms=MAX_TEXT_SEARCH_TERMS, prefix=True):
+    import pandas as pd
+    results_columns, results = search_resources_by_text(db_cursor, text, include_subclasses=include_subclasses,
+                                                        direct_subclasses_only=direct_subclasses_only,
+                                                        max_ontology_terms=max_ontology_terms, prefix=prefix)
+    return pd.DataFrame(results, columns=results_columns)
 
-    do_example_queries(cursor)
-    do_example_queries(cursor, search_terms=["EFO:0005741"])       # infectious disease
-    do_example_queries(cursor, search_terms=["EFO:0004324"])       # body weights and measures
-    do_example_queries(cursor, search_terms=["NCIT:C3303"])        # pain
-    do_example_queries(cursor, search_terms=["FOODON:00001248"])   # fish food product
 
+def search_resources_by_text(db_cursor, text, include_subclasses=True, direct_subclasses_only=False,
+                             max_ontology_terms=MAX_TEXT_SEARCH_TERMS, prefix=True):
+    # Resolve the given free text to the best matching ontology terms (according to the full-text search rank of their
+    # labels and synonyms), and get the mappings to those terms or, optionally, to their direct or indirect subclasses,
+    # ordered by the rank of the matching ontology term and then by variable. A mapping reached through several matching
+    # terms is listed once, with the best ranked of those terms
+    select_clause = '''SELECT 
+                    m.Variable, 
+                    m.`Table`, 
+                    m.SourceTerm, 
+                    m.MappedTermLabel, 
+                    m.MappedTermCURIE, 
+                    m.MappingScore,
+                    t.Subject AS MatchedTermCURIE,
+                    t.rank AS MatchRank
+                FROM matched_terms t'''
+    query = '''WITH matched_terms AS (
+                    SELECT Subject, MIN(rank) AS rank FROM ''' + ONTOLOGY_TERMS_FTS_TABLE + '''
+                    WHERE ''' + ONTOLOGY_TERMS_FTS_TABLE + ''' MATCH ?
+                    GROUP BY Subject ORDER BY rank LIMIT ?),
+                matched_mappings AS (\n'''
+    query += select_clause + "\nJOIN " + ONTOLOGY_MAPPINGS_TABLE + " m ON (m.MappedTermCURIE = t.Subject)"
+    if include_subclasses:
+        ontology_table = "ontology_edges" if direct_subclasses_only else "ontology_entailed_edges"
+        query += "\nUNION ALL\n" + select_clause + "\nJOIN " + ontology_table + " ee ON (ee.Object = t.Subject)" + \
+                 "\nJOIN " + ONTOLOGY_MAPPINGS_TABLE + " m ON (m.MappedTermCURIE = ee.Subject)"
+    # with MIN(), SQLite takes the bare MatchedTermCURIE column from the row with the minimum (best) rank
+    query += ''')
+                SELECT Variable, `Table`, SourceTerm, MappedTermLabel, MappedTermCURIE, MappingScore, MatchedTermCURIE,
+                    MIN(MatchRank) AS MatchRank
+                FROM matched_mappings
+                GROUP BY Variable, `Table`, SourceTerm, MappedTermLabel, MappedTermCURIE, MappingScore
+                ORDER BY MatchRank, Variable'''
+
+    results = db_cursor.execute(query, (to_full_text_query(text, prefix=prefix), max_ontology_terms)).fetchall()
+    results_columns = [x[0] for x in db_cursor.description]
+    return results_columns, results
+
+
+def search_variables_by_text(db_cursor, text, limit=None, prefix=True):
+    # Get the NHANES variables whose labels or text match the given free text, ordered by full-text search rank
+    query = '''SELECT v.Variable, v.`Table`, v.SASLabel, v.EnglishText, f.rank AS MatchRank
+                FROM ''' + NHANES_VARIABLES_FTS_TABLE + ''' f
+                JOIN nhanes_variables_metadata v ON (v.rowid = f.rowid)
+                WHERE ''' + NHANES_VARIABLES_FTS_TABLE + ''' MATCH ?
+                ORDER BY f.rank LIMIT ?'''
+    results = db_cursor.execute(query, (to_full_text_query(text, prefix=prefix), -1 if limit is None else limit))
+    results = results.fetchall()
+    results_columns = [x[0] for x in db_cursor.description]
+    return results_columns, results
+
+
+def to_full_text_query(text, prefix=True):
+    # Convert free text into an FTS5 query that matches all of its words (or words starting with them, if prefix=True)
+    words = re.findall(r"\w+", text)
+    if not words:
+        raise ValueError("There are no words to search for in: " + text)
+    return " ".join('"' + word + '"' + ("*" if prefix else "") for word in words)
+
+
+def print_results(results_columns, results, output_format="tsv", output=sys.stdout):
+    if output_format == "json":
+        json.dump([dict(zip(results_columns, row)) for row in results], output)
+        output.write("\n")
+    else:
+        output.write("\t".join(results_columns) + "\n")
+        for row in results:
+            output.write("\t".join("" if value is None else str(value) for value in row) + "\n")
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Search for NHANES variables annotated with the given ontology terms "
+                                                 "or their subclasses. Without search terms, run example queries.")
+    parser.add_argument("search_terms", nargs="*", help="CURIEs of the ontology terms to search for, e.g. EFO:0005741")
+    parser.add_argument("-d", "--database", default=DATABASE_FILE, help="NHANES metadata database file")
+    parser.add_argument("-n", "--no-subclasses", action="store_true", help="do not include subclasses of the terms")
+    parser.add_argument("-D", "--direct-subclasses-only", action="store_true",
+                        help="include only direct (asserted) subclasses of the terms")
+    parser.add_argument("-t", "--text", action="store_true",
+                        help="treat the search terms as free text that is matched against the labels and synonyms of "
+                             "ontology terms, rather than as CURIEs")
+    parser.add_argument("-v", "--variable-text", action="store_true",
+                        help="treat the search terms as free text that is matched against the labels and text of "
+                             "NHANES variables")
+    parser.add_argument("-f", "--format", choices=["tsv", "json"], default="tsv", help="output format")
+    arguments = parser.parse_args(arguments)
+    if arguments.direct_subclasses_only and arguments.variable_text:
+        parser.error("-D/--direct-subclasses-only cannot be used with -v/--variable-text")
+    if arguments.search_terms and (arguments.text or arguments.variable_text):
+        try:
+            to_full_text_query(" ".join(arguments.search_terms))
+        except ValueError as error:  # the text has no words to search for
+            parser.error(str(error))
+    if not os.path.isfile(arguments.database):
+        parser.error(f"database file not found: {arguments.database} (build it with build_database.py)")
+
+    # open the database read-only, so that searches can never modify it
+    connection = sqlite3.connect(pathlib.Path(arguments.database).absolute().as_uri() + "?mode=ro", uri=True)
+    cursor = connection.cursor()
+    if arguments.search_terms and arguments.variable_text:
+        results_columns, results = search_variables_by_text(cursor, " ".join(arguments.search_terms))
+        print_results(results_columns, results, output_format=arguments.format)
+    elif arguments.search_terms and arguments.text:
+        results_columns, results = search_resources_by_text(cursor, " ".join(arguments.search_terms),
+                                                            include_subclasses=not arguments.no_subclasses,
+                                                            direct_subclasses_only=arguments.direct_subclasses_only)
+        print_results(results_columns, results, output_format=arguments.format)
+    elif arguments.search_terms:
+        results_columns, results = search_resources(cursor, arguments.search_terms,
+                                                    include_subclasses=not arguments.no_subclasses,
+                                                    direct_subclasses_only=arguments.direct_subclasses_only)
+        print_results(results_columns, results, output_format=arguments.format)
+    else:
+        do_example_queries(cursor)
+        do_example_queries(cursor, search_terms=["EFO:0005741"])       # infectious disease
+        do_example_queries(cursor, search_terms=["EFO:0004324"])       # body weights and measures
+        do_example_queries(cursor, search_terms=["NCIT:C3303"])        # pain
+        do_example_queries(cursor, search_terms=["FOODON:00001248"])   # fish food product
     cursor.close()
     connection.close()
+
+
+if __name__ == '__main__':
+    main()
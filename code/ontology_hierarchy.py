@@ -0,0 +1,163 @@
+import os
+import sqlite3
+import numpy as np
+
+__version__ = "0.1.2"
+
+SUBJECT_COL = "Subject"
+OBJECT_COL = "Object"
+BLANK_NODE_PREFIX = "_:"
+
+# Files that make up a saved hierarchy bundle. CURIEs are stored sorted, as UTF-8 byte strings, so that a CURIE's
+# integer identifier is its position in the array and can be found by binary search on the memory-mapped file
+CURIES_FILE = "curies.npy"
+PARENT_INDPTR_FILE = "parent_indptr.npy"
+PARENT_INDICES_FILE = "parent_indices.npy"
+CHILD_INDPTR_FILE = "child_indptr.npy"
+CHILD_INDICES_FILE = "child_indices.npy"
+
+
+class OntologyHierarchy:
+    # Compact representation of an ontology's class hierarchy: CURIEs are interned to int32 identifiers and the
+    # subclass edges are stored as two CSR adjacency structures, one from each term to its parents and one from each
+    # term to its children. The parents of term i are parent_indices[parent_indptr[i]:parent_indptr[i+1]]
+
+    def __init__(self, curies, parent_indptr, parent_indices, child_indptr, child_indices):
+        self.curies = curies
+        self.parent_indptr = parent_indptr
+        self.parent_indices = parent_indices
+        self.child_indptr = child_indptr
+        self.child_indices = child_indices
+
+    @classmethod
+    def from_edges(cls, subjects, objects):
+        # Build the hierarchy from parallel sequences of (subclass, superclass) CURIEs
+        subjects = np.char.encode(np.asarray(subjects, dtype=str), "utf-8")
+        objects = np.char.encode(np.asarray(objects, dtype=str), "utf-8")
+        curies = np.unique(np.concatenate([subjects, objects]))
+        child_ids = np.searchsorted(curies, subjects).astype(np.int32)
+        parent_ids = np.searchsorted(curies, objects).astype(np.int32)
+        edges = np.unique(np.stack([child_ids, parent_ids], axis=1), axis=0) if child_ids.size \
+            else np.empty((0, 2), dtype=np.int32)
+        parent_indptr, parent_indices = _to_csr(edges[:, 0], edges[:, 1], len(curies))
+        child_indptr, child_indices = _to_csr(edges[:, 1], edges[:, 0], len(curies))
+        return cls(curies, parent_indptr, parent_indices, child_indptr, child_indices)
+
+    @classmethod
+    def from_edges_df(cls, edges_df, subject_col=SUBJECT_COL, object_col=OBJECT_COL):
+        # Build the hierarchy from an edges data frame such as those produced by generate_ontology_tables, ignoring
+        # blank nodes as from_semsql does
+        edges_df = edges_df.dropna(subset=[subject_col, object_col])
+        edges_df = edges_df[~(edges_df[subject_col].str.startswith(BLANK_NODE_PREFIX) |
+                              edges_df[object_col].str.startswith(BLANK_NODE_PREFIX))]
+        return cls.from_edges(edges_df[subject_col].to_numpy(), edges_df[object_col].to_numpy())
+
+    @classmethod
+    def from_semsql(cls, db_file):
+        # Build the hierarchy from the asserted subclass edges in a SemanticSQL database, ignoring blank nodes
+        connection = sqlite3.connect(db_file)
+        try:
+            edges = connection.execute("SELECT DISTINCT subject, object FROM edge WHERE predicate='rdfs:subClassOf' "
+                                       "AND substr(subject, 1, 2) != '_:' AND substr(object, 1, 2) != '_:'").fetchall()
+        finally:
+            connection.close()
+        subjects = [edge[0] for edge in edges]
+        objects = [edge[1] for edge in edges]
+        return cls.from_edges(subjects, objects)
+
+    @classmethod
+    def load(cls, folder, mmap_mode="r"):
+        # Load a hierarchy bundle saved with save(). By default the arrays are memory-mapped rather than read
+        def load_array(file_name):
+            return np.load(os.path.join(folder, file_name), mmap_mode=mmap_mode)
+        return cls(load_array(CURIES_FILE), load_array(PARENT_INDPTR_FILE), load_array(PARENT_INDICES_FILE),
+                   load_array(CHILD_INDPTR_FILE), load_array(CHILD_INDICES_FILE))
+
+    def save(self, folder):
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        np.save(os.path.join(folder, CURIES_FILE), self.curies)
+        np.save(os.path.join(folder, PARENT_INDPTR_FILE), self.parent_indptr)
+        np.save(os.path.join(folder, PARENT_INDICES_FILE), self.parent_indices)
+        np.save(os.path.join(folder, CHILD_INDPTR_FILE), self.child_indptr)
+        np.save(os.path.join(folder, CHILD_INDICES_FILE), self.child_indices)
+
+    def __len__(self):
+        return len(self.curies)
+
+    def __contains__(self, curie):
+        return self.term_id(curie) is not None
+
+    def term_id(self, curie):
+        # Get the integer identifier of the given CURIE, or None if the CURIE is not in the hierarchy
+        key = curie.encode("utf-8")
+        position = int(np.searchsorted(self.curies, key))
+        if position < len(self.curies) and self.curies[position] == key:
+            return position
+        return None
+
+    def curie(self, term_id):
+        return self.curies[term_id].decode("utf-8")
+
+    def parents(self, curie):
+        return self._to_curies(self._neighbours(self.parent_indptr, self.parent_indices, self._ids([curie])))
+
+    def children(self, curie):
+        return self._to_curies(self._neighbours(self.child_indptr, self.child_indices, self._ids([curie])))
+
+    def ancestors(self, curie, include_self=False):
+        term_ids = self._ids([curie])
+        ancestor_ids = self._reachable(self.parent_indptr, self.parent_indices, term_ids, include_self)
+        return self._to_curies(ancestor_ids)
+
+    def descendants(self, curie, include_self=False):
+        term_ids = self._ids([curie])
+        descendant_ids = self._reachable(self.child_indptr, self.child_indices, term_ids, include_self)
+        return self._to_curies(descendant_ids)
+
+    def lowest_common_ancestors(self, curie_1, curie_2):
+        # Get the most specific terms that are ancestors of (or equal to) both given terms
+        ancestors_1 = self._reachable(self.parent_indptr, self.parent_indices, self._ids([curie_1]), True)
+        ancestors_2 = self._reachable(self.parent_indptr, self.parent_indices, self._ids([curie_2]), True)
+        common = np.intersect1d(ancestors_1, ancestors_2, assume_unique=True)
+        # discard the common ancestors that are superclasses of other common ancestors
+        common_parents = self._neighbours(self.parent_indptr, self.parent_indices, common)
+        redundant = self._reachable(self.parent_indptr, self.parent_indices, common_parents, True)
+        return self._to_curies(np.setdiff1d(common, redundant, assume_unique=True))
+
+    def _ids(self, curies):
+        term_ids = [self.term_id(curie) for curie in curies]
+        return np.array([term_id for term_id in term_ids if term_id is not None], dtype=np.int32)
+
+    def _to_curies(self, term_ids):
+        return [self.curie(term_id) for term_id in term_ids]
+
+    @staticmethod
+    def _neighbours(indptr, indices, term_ids):
+        # Gather the adjacency lists of all the given terms in one vectorized operation
+        starts = indptr[term_ids]
+        lengths = indptr[term_ids + 1] - starts
+        total = int(lengths.sum())
+        if total == 0:
+            return np.empty(0, dtype=np.int32)
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return np.unique(indices[offsets + np.arange(total)])
+
+    def _reachable(self, indptr, indices, term_ids, include_self):
+        # Breadth-first traversal, one frontier (rather than one term) at a time
+        visited = np.zeros(len(self.curies), dtype=bool)
+        if include_self:
+            visited[term_ids] = True
+        frontier = np.asarray(term_ids, dtype=np.int32)
+        while frontier.size > 0:
+            frontier = self._neighbours(indptr, indices, frontier)
+            frontier = frontier[~visited[frontier]]
+            visited[frontier] = True
+        return np.flatnonzero(visited).astype(np.int32)
+
+
+def _to_csr(source_ids, target_ids, size):
+    order = np.argsort(source_ids, kind="stable")
+    indptr = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(source_ids, minlength=size), out=indptr[1:])
+    return indptr, target_ids[order].astype(np.int32)
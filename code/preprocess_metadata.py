@@ -2,6 +2,7 @@ import pandas as pd
 import numpy as np
 import text2term
 import os
+from table_schemas import read_table
 
 PROCESSED_TEXT_COL = "ProcessedText"
 PHENOTYPE_COL = "IsPhenotype"
@@ -19,7 +20,7 @@ OUTPUT_FILE = "../metadata/nhanes_variables_processed.tsv"
 
 def preprocess(input_file, column_to_process, save_processed_table=False, input_file_col_separator=","):
     print("Preprocessing metadata table...")
-    df = pd.read_csv(input_file, sep=input_file_col_separator, lineterminator="\n")
+    df = read_table(input_file, sep=input_file_col_separator, lineterminator="\n")
     text_to_process = df[column_to_process].values.tolist()
     with open("temp.txt", 'w') as temp_file:
         temp_file.write('\n'.join(str(item) for item in text_to_process))
@@ -53,7 +54,7 @@ def _mark_phenotpyes(df):
     return df
 
 def _replace_synonym_labels(df):
-    synonyms_df = pd.read_csv(SYNONYM_TABLE, sep='\t')
+    synonyms_df = read_table(SYNONYM_TABLE)
     for index, row in synonyms_df.iterrows():
         df.loc[(df['Variable'] == row['Variable']) & \
                 (df['Table'] == row['Table']), PROCESSED_TEXT_COL] = row["Synonym"]
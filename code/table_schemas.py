@@ -0,0 +1,82 @@
+import os
+import pandas as pd
+
+__version__ = "0.1.0"
+
+# Column data types of the TSV files produced and read by the NHANES metadata utilities. Highly repetitive text columns
+# are read as categoricals, mapping scores as 32-bit floats and TRUE/FALSE flags as nullable booleans, rather than as
+# the default object (Python string) columns. Columns not listed here are left to pandas' type inference
+CATEGORY = "category"
+BOOLEAN = "boolean"
+SCORE_DTYPE = "float32"
+MAPPING_SCORE_COL = "MappingScore"
+
+# metadata/nhanes_variables.tsv and metadata/nhanes_variables_processed.tsv
+NHANES_VARIABLES_DTYPES = {
+    "Variable": str, "Table": CATEGORY, "SASLabel": str, "EnglishText": str, "EnglishInstructions": str,
+    "Target": CATEGORY, "UseConstraints": CATEGORY, "ProcessedText": str, "Tags": CATEGORY,
+    "IsPhenotype": BOOLEAN, "OntologyMapped": BOOLEAN
+}
+
+# metadata/nhanes_tables.tsv
+NHANES_TABLES_DTYPES = {
+    "Table": str, "TableName": str, "BeginYear": "Int16", "EndYear": "Int16", "DataGroup": CATEGORY,
+    "UseConstraints": CATEGORY, "DocFile": str, "DataFile": str, "DatePublished": CATEGORY
+}
+
+# ontology-mappings/*_mappings.tsv. Mappings data frames in memory use text2term's column names, which are the same
+# names with spaces (e.g. 'Mapping Score'), see apply_dtypes
+MAPPINGS_DTYPES = {
+    "Variable": str, "Table": CATEGORY, "SourceTermID": str, "SourceTerm": str, "MappedTermLabel": CATEGORY,
+    "MappedTermCURIE": CATEGORY, "MappedTermIRI": CATEGORY, MAPPING_SCORE_COL: SCORE_DTYPE, "Tags": CATEGORY,
+    "Ontology": CATEGORY, "Comments": str
+}
+
+# ontology-tables/ontology_*.tsv and the per-ontology tables (e.g. efo_labels.tsv)
+ONTOLOGY_TABLES_DTYPES = {
+    "Subject": str, "Object": str, "IRI": str, "DiseaseLocation": str, "Ontology": CATEGORY,
+    "Direct": "Int32", "Inherited": "Int32"
+}
+
+# code/resources/synonym_table.tsv
+VARIABLE_SYNONYMS_DTYPES = {"Variable": str, "Table": CATEGORY, "Synonym": str}
+
+ONTOLOGY_TABLE_SUFFIXES = ("_labels.tsv", "_edges.tsv", "_dbxrefs.tsv", "_synonyms.tsv")
+
+
+def get_dtypes(table_file, score_dtype=SCORE_DTYPE):
+    # Get the column data types of the given TSV file according to its name, or an empty dictionary if it is not one
+    # of the known tables. Pass score_dtype="float64" to keep the mapping scores exactly as written in the file
+    file_name = os.path.basename(table_file)
+    if file_name.startswith("nhanes_variables") and not file_name.endswith("_mappings.tsv"):
+        dtypes = NHANES_VARIABLES_DTYPES
+    elif file_name == "nhanes_tables.tsv":
+        dtypes = NHANES_TABLES_DTYPES
+    elif "_mappings" in file_name:
+        dtypes = MAPPINGS_DTYPES
+    elif file_name.endswith(ONTOLOGY_TABLE_SUFFIXES):
+        dtypes = ONTOLOGY_TABLES_DTYPES
+    elif file_name == "synonym_table.tsv":
+        dtypes = VARIABLE_SYNONYMS_DTYPES
+    else:
+        return {}
+    dtypes = dict(dtypes)
+    if MAPPING_SCORE_COL in dtypes:
+        dtypes[MAPPING_SCORE_COL] = score_dtype
+    return dtypes
+
+
+def read_table(table_file, sep="\t", score_dtype=SCORE_DTYPE, **kwargs):
+    # Read the given table with the column data types of its schema. Columns missing from the file are ignored
+    return pd.read_csv(table_file, sep=sep, dtype=get_dtypes(table_file, score_dtype=score_dtype), **kwargs)
+
+
+def apply_dtypes(data_frame, dtypes):
+    # Convert the columns of the given data frame to the given data types, matching column names regardless of spaces
+    # so that the schemas also apply to data frames with text2term's column names
+    column_dtypes = {}
+    for column in data_frame.columns:
+        dtype = dtypes.get(column.replace(" ", ""))
+        if dtype is not None and dtype is not str:
+            column_dtypes[column] = dtype
+    return data_frame.astype(column_dtypes)